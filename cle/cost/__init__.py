@@ -29,6 +29,25 @@ def NllMul(y, y_hat):
     return nll
 
 
+def NllMulInd(y, y_hat):
+    """
+    Multi cross-entropy
+    Efficient implementation using the integer labels
+    instead of one-hot vectors
+
+    Parameters
+    ----------
+    y     : TensorVariable
+        Integer labels, one per row of y_hat
+        (a trailing axis of length 1 is allowed)
+    y_hat : TensorVariable
+    """
+    y = T.cast(y.flatten(), 'int32')
+    y_hat_2d = y_hat.reshape((y.shape[0], y_hat.shape[-1]))
+    nll = -T.log(y_hat_2d[T.arange(y.shape[0]), y])
+    return nll.reshape(y_hat.shape[:-1], ndim=y_hat.ndim - 1)
+
+
 def MSE(y, y_hat):
     """
     Mean squared error
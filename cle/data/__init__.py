@@ -1,5 +1,147 @@
 import ipdb
+import hashlib
+import inspect
 import numpy as np
+import os
+import Queue
+import shutil
+import sys
+import tempfile
+import threading
+
+from cle.cle.data.worker import WorkerPool
+
+
+def save_npy_dir(path, arrays):
+    """
+    Save each array of the dict `arrays` as path/key.npy
+
+    Files are written under a temporary name and renamed,
+    so that concurrent readers never see a partial file.
+    """
+    if not os.path.exists(path):
+        try:
+            os.makedirs(path)
+        except OSError:
+            if not os.path.isdir(path):
+                raise
+    for key, value in arrays.items():
+        with tempfile.NamedTemporaryFile(dir=path, suffix='.npy',
+                                         delete=False) as f:
+            np.save(f, value)
+        os.rename(f.name, os.path.join(path, key + '.npy'))
+
+
+def load_npy_dir(path, keys, mmap_mode='r'):
+    """
+    Load path/key.npy for each key into a dict
+    """
+    return dict((key, np.load(os.path.join(path, key + '.npy'),
+                              mmap_mode=mmap_mode)) for key in keys)
+
+
+def is_fresh(path, keys, source):
+    """
+    Check that path/key.npy exists for every key
+    and is not older than source.
+    """
+    mtime = os.path.getmtime(source)
+    for key in keys:
+        npy = os.path.join(path, key + '.npy')
+        if not os.path.exists(npy) or os.path.getmtime(npy) < mtime:
+            return False
+    return True
+
+
+def reuse_buffer(out, key, shape, dtype):
+    """
+    Return an array of the given shape backed by the scratch
+    buffer stored under key in the dict out.
+    The buffer only grows along the first axis, smaller requests
+    get a view of it. If out is None, a new array is allocated.
+    """
+    dtype = np.dtype(dtype)
+    if out is None:
+        return np.empty(shape, dtype=dtype)
+    buf = out.get(key, None)
+    if (buf is None or buf.dtype != dtype or
+            buf.shape[1:] != tuple(shape[1:]) or buf.shape[0] < shape[0]):
+        buf = np.empty(shape, dtype=dtype)
+        out[key] = buf
+    return buf[:shape[0]]
+
+
+def accepts_out(fn):
+    """
+    Whether fn takes an out argument, providers written before
+    scratch buffers existed define slices(start, end) only
+    """
+    try:
+        args, varargs, _, _ = inspect.getargspec(fn)
+    except TypeError:
+        return True
+    return 'out' in args or varargs is not None
+
+
+def ragged_arange(lengths):
+    """
+    Concatenation of arange(n) for each n in lengths
+
+    >>> ragged_arange([2, 3])
+    array([0, 1, 0, 1, 2])
+    """
+    lengths = np.asarray(lengths)
+    return (np.arange(lengths.sum()) -
+            np.repeat(np.cumsum(lengths) - lengths, lengths))
+
+
+def seq_lengths(batch):
+    if isinstance(batch, RaggedArray):
+        return batch.lengths
+    return np.array([len(sample) for sample in batch])
+
+
+class RaggedArray(object):
+    """
+    Variable length sequences packed into one flat array
+
+    Sequence i is values[starts[i]:starts[i]+lengths[i]],
+    slicing and indexing only touch starts and lengths,
+    so every batch is a view on the same values.
+
+    Parameters
+    ----------
+    values  : ndArray or RaggedArray
+    starts  : ndArray of ints
+    lengths : ndArray of ints
+    """
+    def __init__(self, values, starts, lengths):
+        self.values = values
+        self.starts = np.asarray(starts)
+        self.lengths = np.asarray(lengths)
+
+    @classmethod
+    def pack(cls, seqs):
+        lengths = np.array([len(seq) for seq in seqs])
+        return cls(np.concatenate(seqs), np.cumsum(lengths) - lengths,
+                   lengths)
+
+    @property
+    def shape(self):
+        return (len(self.starts),)
+
+    @property
+    def dtype(self):
+        return self.values.dtype
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, (int, np.integer)):
+            start = self.starts[idx]
+            return self.values[start:start + self.lengths[idx]]
+        return RaggedArray(self.values, self.starts[idx], self.lengths[idx])
 
 
 class Data(object):
@@ -10,17 +152,132 @@ class Data(object):
     ----------
     .. todo::
     """
-    def __init__(self, name, path):
+    # Attributes which change the output of load, used as cache key
+    cache_params = []
+
+    def __init__(self, name, path, mmap_mode=None, cache_dir=None):
         self.name = name
-        self.data = self.load(path)
+        self.mmap_mode = mmap_mode
+        self.cache_dir = cache_dir
+        if self.cache_dir is None:
+            self.data = self.load(path)
+        else:
+            self.data = self.cached_load(path)
 
     def load(self, path):
-        return np.load(path)
+        return np.load(path, mmap_mode=self.mmap_mode)
+
+    def unpack(self, path):
+        """
+        Return every array stored in path as a dict,
+        this is used to build the on-disk layout of mmap_load.
+        The default assumes an npz file.
+        """
+        data = np.load(path)
+        return dict((key, data[key]) for key in data.files)
 
-    def slices(self, i):
+    def mmap_load(self, path, keys, npy_dir=None):
+        """
+        Memory-map the arrays `keys` of a packed file such as npz,
+        which cannot be mapped directly.
+        The arrays are unpacked once into a directory of .npy files,
+        later calls (and other processes) only map them.
+
+        Parameters
+        ----------
+        path    : string
+        keys    : list of strings
+        npy_dir : string
+            Where to unpack the arrays, defaults to cache_dir or,
+            without one, to the temporary directory. The source
+            directory is never written to.
+        """
+        if npy_dir is None:
+            npy_dir = self.cache_dir or tempfile.gettempdir()
+        path = os.path.abspath(path)
+        npy_path = os.path.join(npy_dir, '%s_%s_npy' % (
+            os.path.splitext(os.path.basename(path))[0],
+            hashlib.sha1(path).hexdigest()[:12]))
+        if not is_fresh(npy_path, keys, path):
+            save_npy_dir(npy_path, self.unpack(path))
+        return load_npy_dir(npy_path, keys, self.mmap_mode)
+
+    def slices(self, start, end, out=None):
         raise NotImplementedError(
             str(type(self)) + " does not implement Data.slice.")
 
+    def cache_key(self, path):
+        key = [self.__class__.__name__, self.name]
+        for p in path if isinstance(path, (list, tuple)) else [path]:
+            key += [os.path.abspath(p), os.path.getmtime(p)]
+        key += [(param, getattr(self, param)) for param in self.cache_params]
+        return hashlib.sha1(repr(key)).hexdigest()
+
+    def cached_load(self, path):
+        """
+        Load the preprocessed data from cache_dir, memory-mapped
+        with mmap_mode if one is given and read in full otherwise,
+        running load and storing its result on a cache miss.
+        Entries are keyed by the source files, their mtime
+        and the attributes listed in cache_params.
+        """
+        cache_path = os.path.join(self.cache_dir, '%s_%s_%s' % (
+            self.__class__.__name__, self.name, self.cache_key(path)))
+        if not os.path.exists(cache_path):
+            arrays = self.to_arrays(self.load(path))
+            # Build the entry aside and rename it, so that concurrent
+            # jobs never see an incomplete one.
+            tmp_path = cache_path + '.tmp%d' % os.getpid()
+            save_npy_dir(tmp_path, arrays)
+            try:
+                os.rename(tmp_path, cache_path)
+            except OSError:
+                shutil.rmtree(tmp_path)
+        keys = [os.path.splitext(f)[0] for f in os.listdir(cache_path)]
+        return self.from_arrays(load_npy_dir(cache_path, keys,
+                                             self.mmap_mode))
+
+    def to_arrays(self, data):
+        """
+        Flatten the output of load into a dict of arrays
+        """
+        return dict(('data%d' % i, mat) for i, mat in enumerate(data))
+
+    def from_arrays(self, arrays):
+        """
+        Inverse of to_arrays
+        """
+        return [arrays['data%d' % i] for i in xrange(len(arrays))]
+
+    def gather(self, idx, out=None):
+        """
+        Gather the examples at idx from each matrix of the data
+
+        Parameters
+        ----------
+        idx : ndArray of ints
+        out : dict or None
+            Scratch buffers reused between batches (see reuse_buffer)
+        """
+        idx = np.asarray(idx)
+        rval = []
+        for i, mat in enumerate(self.data):
+            if isinstance(mat, RaggedArray):
+                rval.append(mat[idx])
+                continue
+            if len(idx) and (idx.min() < 0 or idx.max() >= len(mat)):
+                raise IndexError("Example indices should be in [0, %d), "
+                                 "got [%d, %d]." %
+                                 (len(mat), idx.min(), idx.max()))
+            buf = reuse_buffer(out, i, (len(idx),) + mat.shape[1:], mat.dtype)
+            # mode='raise' would make np.take write into a temporary
+            # copy, hence the bounds check above
+            rval.append(np.take(mat, idx, axis=0, mode='clip', out=buf))
+        return rval
+
+    def take(self, idx, out=None):
+        return tuple(self.gather(idx, out))
+
     def num_examples(self):
         return max(mat.shape[0] for mat in self.data)
 
@@ -35,14 +292,43 @@ class Iterator(object):
 
     Parameters
     ----------
-    .. todo::
+    data        : Data
+    batch_size  : int
+    nbatch      : int
+        Number of batches, instead of batch_size
+    start       : int
+    end         : int
+    prefetch    : int
+        Number of batches prepared ahead on a background thread
+    shuffle     : bool
+        Draw a new permutation of the examples at every epoch
+    seed        : int
+    use_partial : bool
+        Yield the last batch even if it is smaller than batch_size
+    sampler     : BucketSampler
+        Yields the index arrays of the batches instead
+    nworker     : int
+        Number of processes building the batches, see WorkerPool
+    slot_bytes  : int
+        Size of the shared buffers of the workers
+    reuse       : bool
+        Build the batches into scratch buffers reused between batches
+        instead of allocating new arrays. A batch is then only valid
+        until the next one is requested, so it must not be kept across
+        iterations, e.g. by list(iterator).
     """
     def __init__(self, data, batch_size=None, nbatch=None,
-                 start=0, end=None):
+                 start=0, end=None, prefetch=0, shuffle=0, seed=None,
+                 use_partial=0, sampler=None, nworker=0, slot_bytes=2**24,
+                 reuse=0):
+        if sampler is not None:
+            batch_size = sampler.batch_size
         if (batch_size or nbatch) is None:
             raise ValueError("Either batch_size or nbatch should be given.")
         if (batch_size and nbatch) is not None:
             raise ValueError("Provide either batch_size or nbatch.")
+        if prefetch < 0:
+            raise ValueError("prefetch should be non-negative.")
         self.start = start
         self.end = data.num_examples() if end is None else end
         if self.start >= self.end or self.start < 0:
@@ -56,12 +342,219 @@ class Iterator(object):
             self.nbatch = int(np.float(self.nexp / float(batch_size)))
         self.data = data
         self.name = self.data.name
+        self.prefetch = prefetch
+        self.shuffle = shuffle
+        self.use_partial = use_partial
+        if self.use_partial and self.nexp % self.batch_size:
+            self.nbatch += 1
+        self.seed = seed
+        self.rng = np.random.RandomState(seed)
+        self.sampler = sampler
+        if self.sampler is not None:
+            self.nbatch = len(self.sampler)
+        self.nworker = nworker
+        self.slot_bytes = slot_bytes
+        if self.nworker and hasattr(self.data, 'stream'):
+            raise ValueError("Workers cannot be used with a streaming data.")
+        self.reuse = reuse
+        self.pool = None
+        self.epoch = 0
+        self.slices_out = accepts_out(self.data.slices)
+        self.take_out = accepts_out(getattr(self.data, 'take', None))
 
     def __iter__(self):
-        start = self.start
-        end = self.end - self.end % self.batch_size
-        for idx in xrange(start, end, self.batch_size):
-            yield self.data.slices(idx, idx + self.batch_size)
+        self.epoch += 1
+        if self.nworker:
+            return self.worker_batches()
+        if self.prefetch:
+            return self.prefetch_batches()
+        return self.batches()
+
+    def batch_indices(self):
+        """
+        Yield a slice per batch, or an index array when shuffling.
+        The permutation is redrawn at every epoch.
+        If a sampler is given, its index arrays are used instead.
+        """
+        if self.sampler is not None:
+            for idx in self.sampler:
+                yield idx
+            return
+        nexp = self.nexp
+        if not self.use_partial:
+            nexp -= nexp % self.batch_size
+        if self.shuffle:
+            perm = self.start + self.rng.permutation(self.nexp)
+            for i in xrange(0, nexp, self.batch_size):
+                yield perm[i:i + self.batch_size]
+        else:
+            for i in xrange(self.start, self.start + nexp, self.batch_size):
+                yield slice(i, min(i + self.batch_size, self.end))
+
+    def batches(self):
+        if hasattr(self.data, 'stream'):
+            # Streaming providers (see cle.data.shard) order the
+            # examples themselves, start, end and shuffle do not apply.
+            for batch in self.data.stream(self.batch_size, self.use_partial):
+                yield batch
+            return
+        # One scratch slot per batch that can be alive at the same time:
+        # the consumed one, the queued ones and the one being built.
+        slots = [{} for i in xrange(self.prefetch + 2)]
+        for i, idx in enumerate(self.batch_indices()):
+            out = slots[i % len(slots)] if self.reuse else None
+            yield self.get_batch(idx, out)
+
+    def get_batch(self, idx, out):
+        """
+        Build the batch at idx, passing the scratch buffers out
+        only to providers that accept them
+        """
+        if isinstance(idx, slice):
+            if self.slices_out:
+                return self.data.slices(idx.start, idx.stop, out)
+            return self.data.slices(idx.start, idx.stop)
+        if self.take_out:
+            return self.data.take(idx, out)
+        return self.data.take(idx)
+
+    def worker_batches(self):
+        """
+        Build the batches in nworker processes (see WorkerPool),
+        with prefetch + 1 batches in flight per worker.
+        The indices are drawn here, and numpy's global RNG is reseeded
+        per batch from (seed, epoch, batch), so the batches only
+        depend on the seed, not on the number of workers.
+        """
+        if self.pool is None:
+            self.pool = WorkerPool(self.nworker, self.prefetch + 1,
+                                   self.slot_bytes)
+        indices = list(self.batch_indices())
+        seed = self.seed
+
+        def make_batch(k, scratch):
+            if seed is None:
+                np.random.seed()
+            else:
+                np.random.seed([seed, self.epoch, k])
+            return self.get_batch(indices[k], scratch)
+        batches = self.pool.run(make_batch, len(indices))
+        if self.reuse:
+            return batches
+        # Batches are views of the shared buffers of the workers
+        return (tuple(np.array(mat) for mat in batch) for batch in batches)
+
+    def prefetch_batches(self):
+        """
+        Prepare the next `prefetch` batches on a background thread
+        while the caller consumes the current one.
+        The producer is stopped and joined when the epoch ends or
+        when the caller stops iterating early.
+        """
+        queue = Queue.Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    queue.put(item, timeout=0.1)
+                    return True
+                except Queue.Full:
+                    pass
+            return False
+
+        def produce():
+            try:
+                for batch in self.batches():
+                    # Slices are often lazy generators, materialize them
+                    # here so the work is done on this thread.
+                    if not put((0, tuple(batch))):
+                        return
+            except Exception:
+                put((1, sys.exc_info()))
+                return
+            put((2, None))
+
+        thread = threading.Thread(target=produce)
+        thread.daemon = True
+        thread.start()
+        try:
+            while True:
+                flag, item = queue.get()
+                if flag == 0:
+                    yield item
+                elif flag == 1:
+                    raise item[0], item[1], item[2]
+                else:
+                    break
+        finally:
+            stop.set()
+            thread.join()
+
+
+class BucketSampler(object):
+    """
+    Batch sampler grouping sequences of similar length,
+    so that padded batches waste fewer scan steps.
+
+    Parameters
+    ----------
+    lengths     : list or ndArray of ints
+        Length of each sequence, see TemporalSeries.seq_lengths
+    batch_size  : int
+    window      : int or None
+        Sort by length within windows of window * batch_size
+        examples, if None sort the whole set at once
+    shuffle     : bool
+        Shuffle the examples before windowing and the order of batches
+    seed        : int
+    use_partial : bool
+        Emit the final partial batch
+    """
+    def __init__(self, lengths, batch_size, window=None, shuffle=1,
+                 seed=None, use_partial=0):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.window = window
+        self.shuffle = shuffle
+        self.use_partial = use_partial
+        self.rng = np.random.RandomState(seed)
+        self.padding_ratio = None
+
+    def __len__(self):
+        nbatch = len(self.lengths) // self.batch_size
+        if self.use_partial and len(self.lengths) % self.batch_size:
+            nbatch += 1
+        return nbatch
+
+    def __iter__(self):
+        nexp = len(self.lengths)
+        if self.shuffle:
+            idx = self.rng.permutation(nexp)
+        else:
+            idx = np.arange(nexp)
+        size = nexp if self.window is None else self.window * self.batch_size
+        for i in xrange(0, nexp, size):
+            chunk = idx[i:i + size]
+            idx[i:i + size] = chunk[np.argsort(self.lengths[chunk],
+                                               kind='mergesort')]
+        end = nexp if self.use_partial else len(self) * self.batch_size
+        batches = [idx[i:i + self.batch_size]
+                   for i in xrange(0, end, self.batch_size)]
+        if self.shuffle:
+            batches = [batches[i] for i in self.rng.permutation(len(batches))]
+        self.padding_ratio = self.padding(batches)
+        for batch in batches:
+            yield batch
+
+    def padding(self, batches):
+        """
+        Fraction of padded timesteps over the given batches
+        """
+        total = sum(len(b) * self.lengths[b].max() for b in batches)
+        used = sum(self.lengths[b].sum() for b in batches)
+        return 1. - used / float(max(total, 1))
+
 
 class DesignMatrix(Data):
     """
@@ -71,7 +564,7 @@ class DesignMatrix(Data):
     ----------
     .. todo::
     """
-    def slices(self, start, end):
+    def slices(self, start, end, out=None):
         return (mat[start:end] for mat in self.data)
 
 
@@ -85,23 +578,72 @@ class TemporalSeries(Data):
     ----------
     .. todo::
     """
-    def slices(self, start, end):
+    def slices(self, start, end, out=None):
         return (mat[start:end].swapaxes(0, 1)
                 for mat in self.data)
 
-    def create_mask(self, batch):
-        samples_len = [len(sample) for sample in batch]
-        max_sample_len = max(samples_len)
-        mask = np.zeros((max_sample_len, len(batch)),
-                        dtype=batch.dtype)
-        for i, sample_len in enumerate(samples_len):
-            mask[:sample_len, i] = 1.
-        return mask
-
-    def zero_pad(self, batch):
-        max_sample_len = max(len(sample) for sample in batch)
-        rval = np.zeros((len(batch), max_sample_len,
-                         batch[0].shape[-1]), batch.dtype)
+    def take(self, idx, out=None):
+        return tuple(mat.swapaxes(0, 1) for mat in self.gather(idx, out))
+
+    def seq_lengths(self):
+        return seq_lengths(self.data[0])
+
+    def create_mask(self, batch, out=None):
+        """
+        Time-major mask of the valid timesteps
+
+        Parameters
+        ----------
+        batch : list or ndArray of sequences
+        out   : ndArray or None
+            Buffer of shape (max_len, len(batch)) to fill in place
+        """
+        samples_len = seq_lengths(batch)
+        if out is None:
+            out = np.empty((samples_len.max(), len(batch)),
+                           dtype=batch[0].dtype)
+        np.less(np.arange(len(out))[:, None], samples_len, out=out)
+        return out
+
+    def zero_pad(self, batch, out=None):
+        """
+        Pad the sequences with zeros into a time-major array
+
+        Parameters
+        ----------
+        batch : list or ndArray of sequences
+        out   : ndArray or None
+            Buffer of shape (max_len, len(batch), ...) to fill in place
+        """
+        if out is None:
+            max_sample_len = seq_lengths(batch).max()
+            out = np.empty((max_sample_len, len(batch)) +
+                           batch[0].shape[1:], dtype=batch[0].dtype)
+        out[...] = 0
+        # One block copy per sequence, a fancy-indexed scatter of the
+        # concatenated batch is slower than this in numpy.
         for i, sample in enumerate(batch):
-            rval[i, :len(sample)] = sample
-        return rval.swapaxes(0, 1)
+            out[:len(sample), i] = sample
+        return out
+
+    def pad_batch(self, batches, out=None):
+        """
+        Zero-pad each matrix of a batch and append the mask,
+        the lengths are taken from the first matrix.
+
+        Parameters
+        ----------
+        batches : list of lists or ndArrays of sequences
+        out     : dict or None
+            Scratch buffers reused between batches (see reuse_buffer)
+        """
+        batch = batches[0]
+        shape = (seq_lengths(batch).max(), len(batch))
+        rval = []
+        for i, batch in enumerate(batches):
+            buf = reuse_buffer(out, ('pad', i), shape + batch[0].shape[1:],
+                               batch[0].dtype)
+            rval.append(self.zero_pad(batch, buf))
+        mask = reuse_buffer(out, ('mask',), shape, batches[0][0].dtype)
+        rval.append(self.create_mask(batches[0], mask))
+        return tuple(rval)
@@ -1,64 +1,268 @@
 import ipdb
 import numpy as np
 import scipy
+import scipy.fftpack
+import scipy.signal
+
+from cle.cle.data import RaggedArray, ragged_arange
+from cle.cle.utils import segment_axis, tolist
+from cle.cle.utils.op import batch_overlap_sum
+
+
+def apply_last(fn, X):
+    """
+    Apply fn along the last axis of every sequence of X
+
+    Dense arrays (padded batches) and RaggedArrays of frames
+    are transformed with a single call, lists and object arrays
+    of sequences are looped over.
+    """
+    if isinstance(X, RaggedArray) and X.values.ndim > 1:
+        return RaggedArray(fn(X.values), X.starts, X.lengths)
+    if isinstance(X, np.ndarray) and X.dtype != object:
+        return fn(X)
+    return np.array([fn(x) for x in X])
+
+
+def cast_like(X, *stats):
+    """
+    Cast statistics to the float dtype of X, float64
+    is only used to accumulate them
+
+    Parameters
+    ----------
+    X     : ndArray or list of ndArrays
+    stats : Scalars or ndArrays
+    """
+    if isinstance(X, np.ndarray) and X.dtype != object:
+        dtype = X.dtype
+    else:
+        dtype = np.asarray(X[0]).dtype
+    if not np.issubdtype(dtype, np.floating):
+        return stats
+    return tuple(np.asarray(stat, dtype=dtype)[()] for stat in stats)
+
+
+def shift_scale(X, shift, scale, out=None, chunk_size=65536):
+    """
+    Compute (X - shift) / scale
+
+    Without out, a new array is returned as with plain numpy
+    arithmetic, with shift and scale cast to the float dtype of X
+    so a float32 X gives a float32 result. Given out, which may be X itself, the result is
+    written into it chunk_size rows at a time, in the dtype of out,
+    so a float32 data set never goes through a float64 copy.
+
+    Parameters
+    ----------
+    X          : ndArray or list of ndArrays
+    shift      : Scalar or ndArray
+    scale      : Scalar or ndArray
+    out        : ndArray or list of ndArrays
+        Same layout as X
+    chunk_size : integer
+    """
+    if out is None:
+        shift, scale = cast_like(X, shift, scale)
+        return (X - shift) / scale
+    if isinstance(X, np.ndarray) and X.dtype != object:
+        for i in xrange(0, len(X), chunk_size):
+            chunk = out[i:i+chunk_size]
+            np.subtract(X[i:i+chunk_size], shift, out=chunk)
+            np.divide(chunk, scale, out=chunk)
+        return out
+    for x, o in zip(X, out):
+        np.subtract(x, shift, out=o)
+        np.divide(o, scale, out=o)
+    return out
+
+
+class RunningStats(object):
+    """
+    Single pass mean, variance, max and min
+
+    Chunks are reduced on their own and merged into the running
+    statistics with Chan et al.'s pairwise update, so data can be
+    fed piece by piece from memmaps or shards without ever being
+    copied as a whole.
+
+    Parameters
+    ----------
+    axis : None, int or tuple of ints
+        None for scalar statistics over all the elements,
+        otherwise the axes reduced over. Rows (axis 0) are merged
+        chunk by chunk when reduced, stacked when they are not.
+    """
+    def __init__(self, axis=None):
+        self.axis = axis
+        self.n = 0
+        self.mean = None
+        self.m2 = None
+        self.max = None
+        self.min = None
+
+    def update(self, x):
+        """
+        Merge a chunk of rows into the statistics
+        """
+        x = np.asarray(x, dtype=np.float64)
+        if self.axis is None:
+            x = x.ravel()
+            axes = (0,)
+        else:
+            axes = tuple(sorted(set(a % x.ndim for a in tolist(self.axis))))
+        if x.shape[0] == 0:
+            return self
+        n = int(np.prod([x.shape[a] for a in axes]))
+        mean = x.mean(axis=axes)
+        m2 = np.square(x - x.mean(axis=axes, keepdims=True)).sum(axis=axes)
+        if self.n == 0 or 0 not in axes:
+            if self.n == 0:
+                self.mean, self.m2 = mean, m2
+                self.max, self.min = x.max(axis=axes), x.min(axis=axes)
+            else:
+                # Rows are kept, the chunk only adds rows
+                self.mean = np.concatenate([self.mean, mean])
+                self.m2 = np.concatenate([self.m2, m2])
+                self.max = np.concatenate([self.max, x.max(axis=axes)])
+                self.min = np.concatenate([self.min, x.min(axis=axes)])
+            self.n = n
+            return self
+        total = self.n + n
+        delta = mean - self.mean
+        self.mean = self.mean + delta * n / total
+        self.m2 = self.m2 + m2 + delta**2 * self.n * n / total
+        self.max = np.maximum(self.max, x.max(axis=axes))
+        self.min = np.minimum(self.min, x.min(axis=axes))
+        self.n = total
+        return self
+
+    def feed(self, X, chunk_size=65536):
+        """
+        Feed X chunk by chunk
+
+        Parameters
+        ----------
+        X          : ndArray, memmap or iterable of chunks
+            Arrays are read chunk_size rows at a time,
+            anything else is iterated over
+        chunk_size : integer
+        """
+        if isinstance(X, np.ndarray) and X.dtype != object:
+            for i in xrange(0, len(X), chunk_size):
+                self.update(X[i:i+chunk_size])
+        else:
+            for x in X:
+                self.update(x)
+        return self
+
+    @property
+    def var(self):
+        return self.m2 / self.n
+
+    @property
+    def std(self):
+        return np.sqrt(self.var)
+
+    def save(self, path):
+        np.savez(path, n=self.n, mean=self.mean, m2=self.m2,
+                 max=self.max, min=self.min,
+                 axis=[] if self.axis is None else tolist(self.axis))
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        axis = tuple(int(a) for a in np.atleast_1d(data['axis']))
+        if len(axis) == 0:
+            axis = None
+        elif len(axis) == 1:
+            axis = axis[0]
+        stats = cls(axis)
+        stats.n = int(data['n'])
+        for key in ['mean', 'm2', 'max', 'min']:
+            setattr(stats, key, data[key])
+        return stats
 
 
 class StaticPrepMixin(object):
     """
     Preprocessing mixin for static data
     """
-    def normalize(self, X, X_mean=None, X_std=None, axis=0):
+    def normalize(self, X, X_mean=None, X_std=None, axis=0, stats=None,
+                  inplace=0, out=None):
         """
         Globally normalize X into zero mean and unit variance
 
         Parameters
         ----------
-        X      : list or ndArray
-        X_mean : Scalar
-        X_std  : Scalar
+        X       : list or ndArray
+        X_mean  : Scalar
+        X_std   : Scalar
+        stats   : RunningStats
+            Statistics to use instead of X_mean and X_std,
+            computed from X when none are given
+        inplace : bool
+            Write the result back into X
+        out     : ndArray or list of ndArrays
+            Buffer for the result, see shift_scale
         """
         if X_mean is None or X_std is None:
-            X_mean = np.array(X).mean(axis=axis)
-            X_std = np.array(X).std(axis=axis)
-            X = (X - X_mean) / X_std
-        else:
-            X = (X - X_mean) / X_std
+            if stats is None:
+                rows = X
+                if not isinstance(X, np.ndarray) and axis is not None and\
+                        len(set(np.shape(x) for x in X)) == 1:
+                    # Examples of one shape are stacked, otherwise
+                    # each would be fed and reduced as its own chunk
+                    rows = np.asarray(X)
+                stats = RunningStats(axis).feed(rows)
+            X_mean, X_std = cast_like(X, stats.mean, stats.std)
+        X = shift_scale(X, X_mean, X_std, X if inplace else out)
         return (X, X_mean, X_std)
 
-    def global_normalize(self, X, X_mean=None, X_std=None):
+    def global_normalize(self, X, X_mean=None, X_std=None, stats=None,
+                         inplace=0, out=None):
         """
         Globally normalize X into zero mean and unit variance
 
         Parameters
         ----------
-        X      : list or ndArray
-        X_mean : Scalar
-        X_std  : Scalar
+        X       : list or ndArray
+        X_mean  : Scalar
+        X_std   : Scalar
+        stats   : RunningStats
+        inplace : bool
+            Write the result back into X
+        out     : ndArray or list of ndArrays
+            Buffer for the result, see shift_scale
         """
         if X_mean is None or X_std is None:
-            X_mean = np.array(X).mean()
-            X_std = np.array(X).std()
-            X = (X - X_mean) / X_std
-        else:
-            X = (X - X_mean) / X_std
+            if stats is None:
+                stats = RunningStats().feed(X)
+            X_mean, X_std = cast_like(X, stats.mean, stats.std)
+        X = shift_scale(X, X_mean, X_std, X if inplace else out)
         return (X, X_mean, X_std)
 
-    def standardize(self, X, X_max=None, X_min=None):
+    def standardize(self, X, X_max=None, X_min=None, stats=None,
+                    inplace=0, out=None):
         """
         Standardize X such that X \in [0, 1]
 
         Parameters
         ----------
-        X     : list of lists or ndArrays
-        X_max : Scalar
-        X_min : Scalar
+        X       : list of lists or ndArrays
+        X_max   : Scalar
+        X_min   : Scalar
+        stats   : RunningStats
+        inplace : bool
+            Write the result back into X
+        out     : ndArray or list of ndArrays
+            Buffer for the result, see shift_scale
         """
         if X_max is None or X_min is None:
-            X_max = np.array(X).max()
-            X_min = np.array(X).min()
-            X = (X - X_min) / (X_max - X_min)
-        else:
-            X = (X - X_min) / (X_max - X_min)
+            if stats is None:
+                stats = RunningStats().feed(X)
+            X_max, X_min = cast_like(X, stats.max, stats.min)
+        X = shift_scale(X, X_min, X_max - X_min, X if inplace else out)
         return (X, X_max, X_min)
 
  
@@ -86,47 +290,55 @@ class SequentialPrepMixin(object):
             X = [x[i] / avr_norm for x in X]
         return X, avr_norm
 
-    def global_normalize(self, X, X_mean=None, X_std=None):
+    def global_normalize(self, X, X_mean=None, X_std=None, stats=None,
+                         inplace=0, out=None):
         """
         Globally normalize X into zero mean and unit variance
 
         Parameters
         ----------
-        X      : list of lists or ndArrays
-        X_mean : Scalar
-        X_std  : Scalar
+        X       : list of lists or ndArrays
+        X_mean  : Scalar
+        X_std   : Scalar
+        stats   : RunningStats
+        inplace : bool
+            Write the result back into X
+        out     : ndArray or list of ndArrays
+            Buffer for the result, see shift_scale
 
         Notes
         -----
-        Compute varaince using the relation
-        >>> Var(X) = E[X^2] - E[X]^2
+        Statistics are merged sequence by sequence,
+        see RunningStats
         """
         if X_mean is None or X_std is None:
-            X_len = np.array([len(x) for x in X]).sum()
-            X_mean = np.array([x.sum() for x in X]).sum() / X_len
-            X_sqr = np.array([(x**2).sum() for x in X]).sum() / X_len
-            X_std = np.sqrt(X_sqr - X_mean**2)
-            X = (X - X_mean) / X_std
-        else:
-            X = (X - X_mean) / X_std
+            if stats is None:
+                stats = RunningStats().feed(X)
+            X_mean, X_std = cast_like(X, stats.mean, stats.std)
+        X = shift_scale(X, X_mean, X_std, X if inplace else out)
         return (X, X_mean, X_std)
 
-    def standardize(self, X, X_max=None, X_min=None):
+    def standardize(self, X, X_max=None, X_min=None, stats=None,
+                    inplace=0, out=None):
         """
         Standardize X such that X \in [0, 1]
 
         Parameters
         ----------
-        X     : list of lists or ndArrays
-        X_max : Scalar
-        X_min : Scalar
+        X       : list of lists or ndArrays
+        X_max   : Scalar
+        X_min   : Scalar
+        stats   : RunningStats
+        inplace : bool
+            Write the result back into X
+        out     : ndArray or list of ndArrays
+            Buffer for the result, see shift_scale
         """
         if X_max is None or X_min is None:
-            X_max = np.array([x.max() for x in X]).max()
-            X_min = np.array([x.min() for x in X]).min()
-            X = (X - X_min) / (X_max - X_min)
-        else:
-            X = (X - X_min) / (X_max - X_min)
+            if stats is None:
+                stats = RunningStats().feed(X)
+            X_max, X_min = cast_like(X, stats.max, stats.min)
+        X = shift_scale(X, X_min, X_max - X_min, X if inplace else out)
         return (X, X_max, X_min)
 
     def numpy_rfft(self, X):
@@ -137,8 +349,7 @@ class SequentialPrepMixin(object):
         ----------
         X     : list of lists or ndArrays
         """
-        X = np.array([np.fft.rfft(x) for x in X])
-        return X
+        return apply_last(np.fft.rfft, X)
 
     def numpy_irfft(self, X):
         """
@@ -148,8 +359,7 @@ class SequentialPrepMixin(object):
         ----------
         X     : list of lists or ndArrays
         """
-        X = np.array([np.fft.irfft(x) for x in X])
-        return X
+        return apply_last(np.fft.irfft, X)
 
     def rfft(self, X):
         """
@@ -159,8 +369,7 @@ class SequentialPrepMixin(object):
         ----------
         X     : list of lists or ndArrays
         """
-        X = np.array([scipy.fftpack.rfft(x) for x in X])
-        return X
+        return apply_last(scipy.fftpack.rfft, X)
 
     def irfft(self, X):
         """
@@ -170,30 +379,62 @@ class SequentialPrepMixin(object):
         ----------
         X     : list of lists or ndArrays
         """
-        X = np.array([scipy.fftpack.irfft(x) for x in X])
-        return X
+        return apply_last(scipy.fftpack.irfft, X)
 
-    def stft(self, X):
+    def stft(self, X, frame_size=None, overlap=None):
         """
         Apply short-time Fourier transform to X
 
+        Each sequence is cut into Hann windowed frames of frame_size
+        samples, shifted by overlap samples, and transformed by a real
+        FFT. A padded batch is framed with segment_axis and transformed
+        in one call. Without frame_size, X is transformed as a whole.
+
         Parameters
         ----------
-        X     : list of lists or ndArrays
+        X          : list of lists or ndArrays
+        frame_size : integer
+        overlap    : integer
+            Shift between frames, frame_size / 2 by default
         """
-        X = np.array([scipy.fft(x) for x in X])
-        return X
-
-    def istft(self, X):
+        if frame_size is None:
+            return apply_last(np.fft.fft, X)
+        if overlap is None:
+            overlap = frame_size / 2
+        w = scipy.signal.hann(frame_size)
+
+        def framed_rfft(x):
+            frames = segment_axis(x, frame_size, frame_size - overlap,
+                                  axis=x.ndim - 1)
+            return np.fft.rfft(frames * w, axis=-1)
+        if isinstance(X, np.ndarray) and X.dtype != object:
+            return framed_rfft(X)
+        return np.array([framed_rfft(np.asarray(x)) for x in X])
+
+    def istft(self, X, frame_size=None, overlap=None):
         """
-        Apply short-time Fourier transform to X
+        Apply inverse short-time Fourier transform to X
+
+        Inverse of stft, the frames are resynthesized and
+        overlap-added with cle.utils.op.batch_overlap_sum.
 
         Parameters
         ----------
-        X     : list of lists or ndArrays
+        X          : list of lists or ndArrays
+        frame_size : integer
+        overlap    : integer
+            Shift between frames, frame_size / 2 by default
         """
-        X = np.array([scipy.real(scipy.ifft(x)) for x in X])
-        return X
+        if frame_size is None:
+            return apply_last(lambda x: np.real(np.fft.ifft(x)), X)
+        if overlap is None:
+            overlap = frame_size / 2
+        frames = apply_last(lambda x: np.fft.irfft(x, n=frame_size), X)
+        if isinstance(frames, np.ndarray) and frames.dtype != object:
+            if frames.ndim == 2:
+                return batch_overlap_sum(frames[np.newaxis], overlap)[0]
+            return batch_overlap_sum(frames, overlap)
+        return np.array([batch_overlap_sum([x], overlap)[0] for x in frames])
 
     def fill_zero1D(self, x, pad_len=0, mode='righthand'):
         """
@@ -234,57 +475,71 @@ class SequentialPrepMixin(object):
 
         Parameters
         ----------
-        X       : list of ndArrays or lists
+        X       : list of ndArrays or lists, or RaggedArray
         pad_len : integer
             if 0, we consider that output should be
-            a design matrix.
+            a design matrix, otherwise a RaggedArray
+            of the padded sequences is returned.
         mode    : string
             Strategy to fill-in the zeros
             'righthand': pad the zeros at the right space
             'lefthand' : pad the zeros at the left space
             'random'   : pad the zeros with randomly
                          chosen left space and right space
+
+        Notes
+        -----
+        Destination offsets of every sequence are computed up
+        front and all values are scattered into a single array.
         """
+        if isinstance(X, RaggedArray):
+            lengths = X.lengths
+            values = X.values[np.repeat(X.starts, lengths) +
+                              ragged_arange(lengths)]
+        else:
+            lengths = np.array([len(x) for x in X])
+            values = np.concatenate([np.asarray(x) for x in X])
         if pad_len == 0:
-            X_max = np.array([len(x) for x in X]).max()
-            new_X = np.zeros((len(X), X_max))
-            for i, x in enumerate(X):
-                free_ = X_max - len(x)
-                if mode == 'lefthand':
-                    new_x = np.concatenate([np.zeros((free_)), x], axis=1)
-                elif mode == 'righthand':
-                    new_x = np.concatenate([x, np.zeros((free_))], axis=1)
-                elif mode == 'random':
-                    j = np.random.randint(free_)
-                    new_x = np.concatenate(
-                        [np.zeros((j)), x, np.zeros((free_ - j))],
-                        axis=1
-                    )
-                new_X[i] = new_x
+            free = lengths.max() - lengths
+            if mode == 'lefthand':
+                offsets = free
+            elif mode == 'righthand':
+                offsets = np.zeros_like(free)
+            elif mode == 'random':
+                offsets = (np.random.rand(len(free)) *
+                           (free + 1)).astype(free.dtype)
+            new_lengths = np.repeat(lengths.max(), len(lengths))
         else:
-            new_X = []
-            for x in X:
-                if mode == 'lefthand':
-                    new_x = np.concatenate([np.zeros((pad_len)), x], axis=1)
-                elif mode == 'righthand':
-                    new_x = np.concatenate([x, np.zeros((pad_len))], axis=1)
-                elif mode == 'random':
-                    new_x = np.concatenate(
-                        [np.zeros((pad_len)), x, np.zeros((pad_len))],
-                         axis=1
-                    )
-                new_X.append(new_x)
-        return new_X
+            if mode == 'lefthand':
+                offsets, new_lengths = pad_len, lengths + pad_len
+            elif mode == 'righthand':
+                offsets, new_lengths = 0, lengths + pad_len
+            elif mode == 'random':
+                offsets, new_lengths = pad_len, lengths + 2 * pad_len
+        new_starts = np.cumsum(new_lengths) - new_lengths
+        new_values = np.zeros((new_lengths.sum(),) + values.shape[1:],
+                              dtype=values.dtype)
+        new_values[np.repeat(new_starts + offsets, lengths) +
+                   ragged_arange(lengths)] = values
+        if pad_len == 0:
+            return new_values.reshape((len(lengths), -1) + values.shape[1:])
+        return RaggedArray(new_values, new_starts, new_lengths)
 
     def reverse(self, X):
         """
         Reverse each sequence of X
 
+        Returns views, a dense array is flipped along
+        its second axis and a RaggedArray keeps its values.
+
         Parameters
         ----------
-        X       : list of ndArrays or lists
+        X       : list of ndArrays or lists, ndArray or RaggedArray
         """
-        new_X = []
-        for x in X:
-            new_X.append(x[::-1])
-        return new_X
+        if isinstance(X, RaggedArray):
+            n = len(X.values)
+            return RaggedArray(X.values[::-1], n - X.starts - X.lengths,
+                               X.lengths)
+        if isinstance(X, np.ndarray) and X.dtype != object:
+            return X[:, ::-1]
+        return [np.asarray(x)[::-1] for x in X]
@@ -0,0 +1,143 @@
+import ipdb
+import numpy as np
+import os
+import sys
+import threading
+import zipfile
+
+from cle.cle.data import Data
+
+
+class ShardedData(Data):
+    """
+    Batch provider streaming a directory of shard files,
+    for corpora which do not fit in memory.
+
+    Every shard is either an .npy file holding one matrix, or an .npz
+    file holding the matrices named by keys. Only the shard being
+    consumed and the next one, read ahead on a background thread,
+    are kept in memory. Batches which straddle two shards are joined.
+
+    Parameters
+    ----------
+    path    : string
+        Directory of the shards, read in sorted filename order
+    keys    : list of strings
+        Matrices to read from .npz shards, defaults to all of them
+    shuffle : bool
+        Visit the shards in a random order and shuffle
+        the examples within each shard, at every epoch
+    seed    : int
+    """
+    def __init__(self, keys=None, shuffle=0, seed=None, **kwargs):
+        if kwargs.get('cache_dir') is not None:
+            # A cache hit would skip load, which indexes the shards
+            raise ValueError("ShardedData reads its shards from disk, "
+                             "it does not support cache_dir.")
+        self.keys = keys
+        self.shuffle = shuffle
+        self.rng = np.random.RandomState(seed)
+        super(ShardedData, self).__init__(**kwargs)
+
+    def load(self, path):
+        self.shards = [os.path.join(path, f) for f in sorted(os.listdir(path))
+                       if os.path.splitext(f)[1] in ('.npy', '.npz')]
+        if len(self.shards) == 0:
+            raise ValueError("No .npy or .npz shard found in %s." % path)
+        if self.keys is None and self.shards[0].endswith('.npz'):
+            self.keys = sorted(np.load(self.shards[0]).files)
+        self.shard_sizes = [self.shard_size(shard) for shard in self.shards]
+        # Nothing is held in memory until iteration starts
+        return []
+
+    def shard_size(self, path):
+        """
+        Number of examples in a shard, read from its header only
+        """
+        if path.endswith('.npy'):
+            return np.load(path, mmap_mode='r').shape[0]
+        with zipfile.ZipFile(path) as archive:
+            f = archive.open(self.keys[0] + '.npy')
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape = np.lib.format.read_array_header_1_0(f)[0]
+            else:
+                shape = np.lib.format.read_array_header_2_0(f)[0]
+        return shape[0]
+
+    def load_shard(self, path):
+        if path.endswith('.npy'):
+            return [np.load(path)]
+        data = np.load(path)
+        return [data[key] for key in self.keys]
+
+    def num_examples(self):
+        return sum(self.shard_sizes)
+
+    def read_ahead(self, order):
+        """
+        Yield the shards in order, loading the next one
+        on a background thread while the current one is consumed.
+        """
+        def start(path):
+            result = {}
+
+            def target():
+                try:
+                    result['shard'] = self.load_shard(path)
+                except Exception:
+                    result['error'] = sys.exc_info()
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+            return thread, result
+
+        pending = start(self.shards[order[0]])
+        for i in xrange(len(order)):
+            thread, result = pending
+            thread.join()
+            if 'error' in result:
+                exc = result['error']
+                raise exc[0], exc[1], exc[2]
+            if i + 1 < len(order):
+                pending = start(self.shards[order[i + 1]])
+            yield result['shard']
+
+    def stream(self, batch_size, use_partial=0):
+        """
+        Yield the batches of one epoch
+        """
+        if self.shuffle:
+            order = self.rng.permutation(len(self.shards))
+        else:
+            order = np.arange(len(self.shards))
+        rest = None
+        for shard in self.read_ahead(order):
+            if self.shuffle:
+                perm = self.rng.permutation(len(shard[0]))
+                shard = [mat[perm] for mat in shard]
+            start = 0
+            nexp = len(shard[0])
+            if rest is not None:
+                start = batch_size - len(rest[0])
+                batch = [np.concatenate([r, mat[:start]])
+                         for r, mat in zip(rest, shard)]
+                if start > nexp:
+                    rest = batch
+                    continue
+                rest = None
+                yield self.prepare(batch)
+            end = start + (nexp - start) // batch_size * batch_size
+            for i in xrange(start, end, batch_size):
+                yield self.prepare([mat[i:i + batch_size] for mat in shard])
+            if end < nexp:
+                rest = [mat[end:] for mat in shard]
+        if rest is not None and use_partial:
+            yield self.prepare(rest)
+
+    def prepare(self, batch):
+        """
+        Turn the list of sliced matrices into the batch handed to
+        the compiled function, override for e.g. time-major data.
+        """
+        return tuple(batch)
@@ -0,0 +1,131 @@
+import ipdb
+import multiprocessing
+import numpy as np
+import Queue
+import traceback
+
+from multiprocessing.sharedctypes import RawArray
+
+
+class WorkerPool(object):
+    """
+    Build batches in forked worker processes and hand them
+    to the trainer through shared memory, without pickling.
+
+    Worker w builds the jobs w, w + nworker, ... and writes each batch
+    into one of its nslot shared buffers, the trainer reads the batches
+    in job order as views of those buffers. A view stays valid until
+    the next batch is requested, like the other iterator buffers.
+    Batches which do not fit in a buffer, or hold Python objects,
+    are sent pickled instead.
+
+    Parameters
+    ----------
+    nworker    : int
+    nslot      : int
+        Number of shared buffers per worker
+    slot_bytes : int
+        Size of each shared buffer
+    poll       : float
+        Seconds to wait for a batch before checking that its
+        worker is still alive
+    """
+    def __init__(self, nworker, nslot=2, slot_bytes=2**24, poll=1.):
+        self.nworker = nworker
+        self.nslot = nslot
+        self.slot_bytes = slot_bytes
+        self.poll = poll
+        # Allocated once, every epoch forks its workers on top of them
+        self.slots = [[RawArray('c', slot_bytes) for s in xrange(nslot)]
+                      for w in xrange(nworker)]
+
+    def run(self, make_batch, njob):
+        """
+        Yield make_batch(k, scratch) for k in 0, ..., njob - 1.
+        make_batch runs in the workers, scratch is a dict the worker
+        keeps between its jobs (see cle.data.reuse_buffer).
+        """
+        queues = [multiprocessing.Queue() for w in xrange(self.nworker)]
+        free = [multiprocessing.Semaphore(self.nslot)
+                for w in xrange(self.nworker)]
+
+        def work(w):
+            scratch = {}
+            for n, k in enumerate(xrange(w, njob, self.nworker)):
+                free[w].acquire()
+                try:
+                    batch = [np.asarray(mat) for mat in make_batch(k, scratch)]
+                except Exception:
+                    queues[w].put(('error', traceback.format_exc()))
+                    return
+                meta = self.pack(batch, self.slots[w][n % self.nslot])
+                if meta is None:
+                    # The queue pickles in a feeder thread after put
+                    # returns, by which time the next job may have
+                    # overwritten the scratch buffers behind batch
+                    queues[w].put(('pickle', [np.array(mat) for mat in batch]))
+                else:
+                    queues[w].put(('shared', meta))
+
+        procs = [multiprocessing.Process(target=work, args=(w,))
+                 for w in xrange(self.nworker)]
+        for proc in procs:
+            proc.daemon = True
+            proc.start()
+        try:
+            for k in xrange(njob):
+                w = k % self.nworker
+                if k > 0:
+                    # The consumer is done with the previous batch
+                    free[(k - 1) % self.nworker].release()
+                kind, item = self.get(queues[w], procs[w], w, k)
+                if kind == 'error':
+                    raise RuntimeError("Worker %d failed on batch %d:\n%s" %
+                                       (w, k, item))
+                elif kind == 'pickle':
+                    yield tuple(item)
+                else:
+                    slot = self.slots[w][(k // self.nworker) % self.nslot]
+                    yield self.unpack(item, slot)
+        finally:
+            for proc in procs:
+                proc.terminate()
+                proc.join()
+
+    def get(self, queue, proc, w, k):
+        """
+        Wait for batch k from worker w, raise if the worker died
+        without sending it (killed, out of memory, ...)
+        """
+        while True:
+            try:
+                return queue.get(timeout=self.poll)
+            except Queue.Empty:
+                if proc.is_alive():
+                    continue
+            # The worker may have put the batch just before exiting
+            try:
+                return queue.get(timeout=self.poll)
+            except Queue.Empty:
+                raise RuntimeError("Worker %d exited with code %s before "
+                                   "sending batch %d" %
+                                   (w, proc.exitcode, k))
+
+    def pack(self, batch, slot):
+        meta = []
+        offset = 0
+        for mat in batch:
+            if mat.dtype.hasobject or offset + mat.nbytes > self.slot_bytes:
+                return None
+            view = np.frombuffer(slot, dtype=mat.dtype, count=mat.size,
+                                 offset=offset)
+            view.reshape(mat.shape)[...] = mat
+            meta.append((mat.dtype.str, mat.shape, offset))
+            # Keep every matrix 64-byte aligned
+            offset += (mat.nbytes + 63) // 64 * 64
+        return meta
+
+    def unpack(self, meta, slot):
+        return tuple(np.frombuffer(slot, dtype=dtype, count=int(np.prod(shape)),
+                                   offset=offset).reshape(shape)
+                     for dtype, shape, offset in meta)
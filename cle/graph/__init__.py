@@ -1,7 +1,205 @@
+import cPickle
+import hashlib
+import logging
+import multiprocessing
+import numpy as np
+import os
+import sys
 import theano
 import theano.tensor as T
 
-from cle.cle.utils import PickleMixin, OrderedDict, tolist
+from theano.compile.pfunc import rebuild_collect_shared
+from theano.compile.sharedvalue import SharedVariable
+from theano.gof import Constant
+from theano.gof.graph import inputs as graph_inputs, io_toposort
+from cle.cle.utils import PickleMixin, OrderedDict, secure_pickle_dump, tolist
+
+
+logger = logging.getLogger(__name__)
+
+
+class UnstableGraph(Exception):
+    """
+    Raised when part of a graph can only be described by a
+    memory address, so it has no key that holds across runs
+    """
+    pass
+
+
+def describe(obj, depth=0):
+    """
+    Description of obj that holds across runs
+
+    Objects whose repr is their address are described by their
+    qualified name, or by their class and attributes.
+    """
+    desc = repr(obj)
+    if ' at 0x' not in desc:
+        return desc
+    if hasattr(obj, '__module__') and hasattr(obj, '__name__'):
+        # Lambdas and nested functions share their name with others
+        # of the same module, only module attributes are unambiguous
+        module = sys.modules.get(obj.__module__)
+        if obj.__name__ == '<lambda>' or\
+                getattr(module, obj.__name__, None) is not obj:
+            raise UnstableGraph(desc)
+        return '%s.%s' % (obj.__module__, obj.__name__)
+    if depth < 2 and hasattr(obj, '__dict__'):
+        return '%s(%s)' % (type(obj).__name__, ', '.join(
+            '%s=%s' % (k, describe(v, depth + 1))
+            for k, v in sorted(vars(obj).items())))
+    raise UnstableGraph(desc)
+
+
+def graph_signature(inputs, outputs):
+    """
+    Structural description of the graph from inputs to outputs
+
+    Variables are numbered in order of appearance, so two graphs
+    built the same way have the same signature whatever the
+    values of their shared variables. Inner graphs of scan ops
+    are described recursively.
+    """
+    ids = {}
+    lines = []
+
+    def var_id(var):
+        if var not in ids:
+            ids[var] = len(ids)
+            if isinstance(var, Constant):
+                data = np.asarray(var.data)
+                desc = 'constant %s %s %s' % (
+                    var.type, data.shape,
+                    hashlib.sha1(data.tostring()).hexdigest())
+            elif isinstance(var, SharedVariable):
+                desc = 'shared %s %s' % (var.type, var.name)
+            else:
+                desc = 'variable %s' % var.type
+            lines.append('%d %s' % (ids[var], desc))
+        return ids[var]
+
+    for var in inputs:
+        var_id(var)
+    for node in io_toposort(graph_inputs(outputs), outputs):
+        op = node.op
+        desc = str(op)
+        for prop in getattr(op, '__props__', ()):
+            desc += ' %s=%s' % (prop, describe(getattr(op, prop, None)))
+        if isinstance(getattr(op, 'info', None), dict):
+            desc += ' ' + describe(sorted((k, describe(v))
+                                          for k, v in op.info.items()))
+        if hasattr(op, 'inputs') and hasattr(op, 'outputs'):
+            desc += ' {%s}' % graph_signature(op.inputs, op.outputs)
+        lines.append('%s(%s) -> %s' % (
+            desc,
+            ', '.join(str(var_id(var)) for var in node.inputs),
+            ', '.join(str(var_id(var)) for var in node.outputs)))
+    lines.append('outputs %s' % [var_id(var) for var in outputs])
+    return '\n'.join(lines)
+
+
+def function_key(inputs, outputs, update_d, shared_inputs):
+    """
+    Hash of the graph, updates and compilation flags, None if
+    the graph cannot be described stably
+    """
+    update_vars = [update_d[sv] for sv in shared_inputs if sv in update_d]
+    try:
+        signature = graph_signature(inputs, tolist(outputs) + update_vars)
+    except UnstableGraph:
+        return None
+    # A single output is returned unwrapped, a list of one is not
+    signature += '\nlist_outputs %s' % isinstance(outputs, (list, tuple))
+    flags = [theano.__version__, theano.config.floatX, theano.config.mode,
+             theano.config.optimizer, theano.config.linker,
+             theano.config.device, theano.config.cxx]
+    updated = [i for i, sv in enumerate(shared_inputs) if sv in update_d]
+    key = hashlib.sha1(signature)
+    key.update(repr(flags))
+    key.update(repr(updated))
+    return key.hexdigest()
+
+
+def load_function(path, ninput, shared_inputs):
+    """
+    Load a cached FunctionMaker and bind it to the current
+    shared variables, None if it cannot be used
+    """
+    reoptimize = theano.config.reoptimize_unpickled_function
+    theano.config.reoptimize_unpickled_function = False
+    try:
+        with open(path, 'rb') as f:
+            maker = cPickle.load(f)
+    except Exception:
+        logger.warning("Could not load the cached function %s" % path)
+        return None
+    finally:
+        theano.config.reoptimize_unpickled_function = reoptimize
+    if len(maker.inputs) != ninput + len(shared_inputs):
+        return None
+    for inp, sv in zip(maker.inputs[ninput:], shared_inputs):
+        if inp.variable.type != sv.type:
+            return None
+    return maker.create([None] * ninput +
+                        [sv.container for sv in shared_inputs])
+
+
+class LazyFunction(object):
+    """
+    Theano function compiled on its first call
+
+    Calling start() compiles it in a worker process instead, the
+    compiled function is shared back through the function cache
+    of the builder and loaded on the first call. Without a
+    function cache, compilation only happens lazily.
+
+    Parameters
+    ----------
+    builder : TheanoMixin
+        Object whose build_theano_graph compiles the function
+    inputs  : list of Theano variables
+    outputs : list of Theano variables
+    updates : dict or list of pairs
+    """
+    def __init__(self, builder, inputs, outputs, updates=[]):
+        self.builder = builder
+        self.inputs = inputs
+        self.outputs = outputs
+        self.updates = updates
+        self.fn = None
+        self.worker = None
+
+    def start(self):
+        if self.fn is not None or self.worker is not None:
+            return
+        if self.builder.function_cache is None:
+            return
+        self.worker = multiprocessing.Process(
+            target=self.builder.build_theano_graph,
+            args=(self.inputs, self.outputs, self.updates))
+        self.worker.daemon = True
+        self.worker.start()
+
+    def compile(self):
+        if self.fn is None:
+            if self.worker is not None:
+                self.worker.join()
+                if self.worker.exitcode != 0:
+                    logger.warning("Compilation worker exited with code %d" %
+                                   self.worker.exitcode)
+                self.worker = None
+            self.fn = self.builder.build_theano_graph(self.inputs,
+                                                      self.outputs,
+                                                      self.updates)
+        return self.fn
+
+    def __call__(self, *args):
+        return self.compile()(*args)
+
+    def __getstate__(self):
+        dic = self.__dict__.copy()
+        dic['worker'] = None
+        return dic
 
 
 class TheanoMixin(object):
@@ -10,9 +208,45 @@ class TheanoMixin(object):
 
     Parameters
     ----------
+    function_cache : str
+        Directory where compiled functions are kept, keyed by
+        the structure of their graph, so that a restarted job with
+        the same graph loads them instead of compiling again
+
     .. todo::
     """
+    function_cache = None
+
+    def build_lazy_graph(self, inputs, outputs, updates=[]):
+        return LazyFunction(self, inputs, outputs, updates)
+
     def build_theano_graph(self, inputs, outputs, updates=[]):
+        if self.function_cache is None:
+            return self.compile_theano_graph(inputs, outputs, updates)
+        if hasattr(updates, 'items'):
+            updates = updates.items()
+        # Collect shared variables the way theano.function does,
+        # a cached function is bound to them in the same order
+        _, cloned_outputs, other = rebuild_collect_shared(
+            outputs, inputs, updates=updates, copy_inputs_over=True)
+        _, update_d, _, shared_inputs = other
+        key = function_key(inputs, cloned_outputs, update_d, shared_inputs)
+        if key is None:
+            logger.warning("The graph has no stable description, "
+                           "it is compiled without the cache")
+            return self.compile_theano_graph(inputs, outputs, updates)
+        path = os.path.join(self.function_cache, key + '.pkl')
+        if os.path.exists(path):
+            f = load_function(path, len(inputs), shared_inputs)
+            if f is not None:
+                return f
+        f = self.compile_theano_graph(inputs, outputs, updates)
+        if not os.path.exists(self.function_cache):
+            os.makedirs(self.function_cache)
+        secure_pickle_dump(f.maker, path)
+        return f
+
+    def compile_theano_graph(self, inputs, outputs, updates=[]):
         return theano.function(inputs=inputs,
                                outputs=outputs,
                                updates=updates,
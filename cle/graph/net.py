@@ -1,7 +1,12 @@
+import copy
+import inspect
 import ipdb
 import theano
+import theano.tensor as T
 
 from collections import OrderedDict
+from cle.cle.graph import TheanoMixin
+from cle.cle.layers.feedforward import FullyConnectedLayer
 from cle.cle.utils import (
     flatten,
     todict,
@@ -9,9 +14,71 @@ from cle.cle.utils import (
     topological_sort,
     PickleMixin
 )
+from itertools import izip
 
 
-class Net(object):
+def merge_projections(x, parname, nodes, use_index=0):
+    """
+    Project an input shared by several nodes with one product
+
+    The W blocks of the nodes are concatenated, x is multiplied
+    once and the result is split back per node. The blocks stay
+    separate shared variables, so params, optimizers and saving
+    see the same parameters as without merging.
+
+    Parameters
+    ----------
+    x       : TensorVariable
+        Input of any ndim, projected along its last axis
+    parname : string
+        Name of the parent x stands for in the nodes
+    nodes     : list of nodes
+        Nodes reading parname with the same parent dimension
+    use_index : bool
+        x holds integer labels along a last axis of size 1,
+        standing for their one-hot vectors, the rows of the
+        concatenated W are gathered instead of multiplied
+
+    Returns
+    -------
+    projs : list of TensorVariables, one per node, without bias
+    """
+    parout = nodes[0].parent[parname]
+    Ws = [node.params['W_'+parname+'__'+node.name] for node in nodes]
+    W = T.concatenate(Ws, axis=1)
+    if use_index:
+        shape = [x.shape[i] for i in xrange(x.ndim - 1)]
+        z = W[T.cast(x.flatten(), 'int32')].reshape(shape + [W.shape[1]],
+                                                    ndim=x.ndim)
+    else:
+        x = x[(slice(None),) * (x.ndim - 1) + (slice(None, parout),)]
+        z = T.dot(x, W)
+    projs = []
+    start = 0
+    for W in Ws:
+        end = start + W.get_value(borrow=True).shape[1]
+        projs.append(z[(slice(None),) * (z.ndim - 1) + (slice(start, end),)])
+        start = end
+    return projs
+
+
+def merge_groups(consumers):
+    """
+    Group the readers of each input, keeping only inputs
+    read by two or more nodes
+
+    Parameters
+    ----------
+    consumers : list of (key, node) pairs
+    """
+    groups = OrderedDict()
+    for key, node in consumers:
+        groups.setdefault(key, []).append(node)
+    return OrderedDict((key, group) for key, group in groups.items()
+                       if len(group) > 1)
+
+
+class Net(TheanoMixin):
     """
     Abstract class for networks
 
@@ -81,18 +148,127 @@ class Net(object):
                 for rec in tolist(recurrent.keys()):
                     self.nodes[node].recurrent[rec] = self.nodes[rec].nout
 
-    def build_graph(self):
-        for node in self.sorted_nodes:
-            inp = []
-            parent = self.nodes[node].parent
-            for par in parent:
-                try:
-                    inp.append(self.inputs[par])
-                except:
-                    inp.append(self.nodes[par].out)
-            self.nodes[node].out = self.nodes[node].fprop(inp)
+    def get_plan(self, sources):
+        """
+        Order in which the nodes are evaluated, with the slots
+        their parents are read from
+
+        Slot i < len(sources) holds the i-th source, the output
+        of the k-th node of the plan goes to slot len(sources) + k.
+
+        Parameters
+        ----------
+        sources : list of strings
+            Names of the values available before any node
+        """
+        if len(self.graph) > 0:
+            order = self.sorted_nodes
+        else:
+            # Assume that you have only single depth (parallel) graph
+            order = self.nodes.keys()
+        inp_slots = {}
+        for i, name in enumerate(sources):
+            inp_slots.setdefault(name, i)
+        out_slots = {}
+        plan = []
+        for nname in order:
+            node = self.nodes[nname]
+            parents = []
+            for par in node.parent:
+                if par in inp_slots:
+                    parents.append(inp_slots[par])
+                elif par in out_slots:
+                    parents.append(out_slots[par])
+                else:
+                    raise KeyError("Node %s reads %s, which is neither an "
+                                   "input nor an earlier node." % (nname, par))
+            out_slots[nname] = len(sources) + len(plan)
+            plan.append((nname, node, parents))
+        return plan
+
+    def build_graph(self, merge=0, set_out=1):
+        """
+        Evaluate the nodes in the order of the plan
+
+        Parameters
+        ----------
+        merge   : bool
+            Fully connected nodes reading the same value project
+            it with one product, see merge_projections
+        set_out : bool
+            Store the output of each node in node.out
+
+        Returns
+        -------
+        outs : OrderedDict of the output of each node by name
+        """
+        outs = OrderedDict()
+        values = self.inputs.values()
+        plan = self.get_plan(self.inputs.keys())
+        groups = {}
+        if merge:
+            consumers = []
+            for nname, node, parents in plan:
+                if isinstance(node, FullyConnectedLayer):
+                    for slot, parout in izip(parents, node.parent.values()):
+                        consumers.append(((slot, parout), node))
+            groups = merge_groups(consumers)
+        projs = {}
+        for nname, node, parents in plan:
+            inp = [values[i] for i in parents]
+            if not groups or not isinstance(node, FullyConnectedLayer):
+                outs[nname] = node.fprop(inp)
+                values.append(outs[nname])
+                continue
+            z_in = None
+            for i, (slot, (parname, parout)) in enumerate(
+                    izip(parents, node.parent.items())):
+                group = groups.get((slot, parout))
+                if group is None:
+                    continue
+                if (slot, parout) not in projs:
+                    projs[(slot, parout)] = dict(izip(
+                        [n.name for n in group],
+                        merge_projections(values[slot], parname, group)))
+                z = projs[(slot, parout)][nname]
+                z_in = z if z_in is None else z_in + z
+                inp[i] = None
+            if z_in is None:
+                outs[nname] = node.fprop(inp)
+            else:
+                outs[nname] = node.fprop(inp, z_in)
+            values.append(outs[nname])
+        if set_out:
+            for nname, out in outs.items():
+                self.nodes[nname].out = out
+        return outs
 
     def build_recurrent_graph(self, n_steps=None, reverse=False, **kwargs):
+        """
+        Unroll the net with scan
+
+        Parameters
+        ----------
+        precompute        : bool
+            Project the sequence inputs of recurrent nodes for all
+            timesteps before scan, leaving only the recurrent terms
+            and the inputs computed in the loop to each step
+        truncate_gradient : int
+            Number of steps to backpropagate through, -1 for all
+        merge             : bool
+            With precompute, sequence inputs read by several
+            recurrent nodes are projected with one product,
+            see merge_projections
+
+        Notes
+        -----
+        The last states of persistent recurrent nodes are
+        returned to their buffers through self.state_updates,
+        which Training adds to its updates.
+        """
+        precompute = kwargs.pop('precompute', 0)
+        truncate_gradient = kwargs.pop('truncate_gradient', -1)
+        merge = kwargs.pop('merge', 0)
         self.nonseq_args = kwargs.pop('nonseq_args', None)
         self.output_args = kwargs.pop('output_args', None)
         self.context_args = kwargs.pop('context_args', None)
@@ -100,12 +276,15 @@ class Net(object):
         self.nonseq_inputs = kwargs.pop('nonseq_inputs', None)
         self.nNone = 0
         inputs = self.inputs.values()
+        names = self.inputs.keys()
+        nonseq_names = []
         seqs = []
         outputs = []
         nonseqs = []
         if self.nonseq_inputs is not None:
             for i in self.nonseq_inputs:
                 nonseqs.append(inputs.pop(i))
+                nonseq_names.append(names.pop(i))
         self.input_args = OrderedDict()
         self.recur_args = OrderedDict()
         for name, node in self.nodes.items():
@@ -121,27 +300,73 @@ class Net(object):
                     if nname == aname:
                         outputs[i] = arg
         if self.iterators is None:
-            seqs += inputs
-        elif self.iterators is not None:
-            seqs += inputs[len(self.iterators):]
-            outputs += inputs[:len(self.iterators)]
+            self.niter = 0
+        else:
+            self.niter = len(self.iterators)
+        seqs += inputs[self.niter:]
+        outputs += inputs[:self.niter]
         if self.output_args is not None:
             self.nNone = len(self.output_args)
         outputs = flatten(outputs + [None] * self.nNone)
         if self.nonseq_args is not None:
             for arg in self.nonseq_args:
                 nonseqs.append(arg)
+        self.proj_args = OrderedDict()
+        if precompute:
+            proj_inputs = OrderedDict()
+            for name, node in self.recur_args.items():
+                # Only layers taking a precomputed projection
+                if 'z_in' not in inspect.getargspec(node.fprop).args:
+                    continue
+                X = []
+                for par in node.parent:
+                    inp = self.inputs.get(par)
+                    if inp is not None and any(inp is seq for seq in seqs):
+                        X.append(inp)
+                    else:
+                        X.append(None)
+                if any(x is not None for x in X):
+                    proj_inputs[name] = X
+            merged = {}
+            if merge:
+                consumers = []
+                for name, X in proj_inputs.items():
+                    node = self.nodes[name]
+                    for x, (par, parout) in izip(X, node.parent.items()):
+                        if x is not None:
+                            consumers.append(((par, parout), node))
+                for (par, parout), group in merge_groups(consumers).items():
+                    projs = merge_projections(self.inputs[par], par, group)
+                    for node, z in izip(group, projs):
+                        merged.setdefault(node.name, []).append((par, z))
+            for name, X in proj_inputs.items():
+                node = self.nodes[name]
+                self.proj_args[name] = [x is not None for x in X]
+                z = None
+                if name in merged:
+                    z = node.params['b_'+name]
+                    for par, proj in merged[name]:
+                        X[node.parent.keys().index(par)] = None
+                        z += proj
+                seqs.append(node.project(X, z))
+        self.nprojs = len(self.proj_args)
         self.nseqs = len(seqs)
-        self.noutputs = len(outputs)
-        self.nnonseqs = len(nonseqs)
+        self.nsources = len(names) + len(nonseq_names)
+        self.set_scan_plan(names[self.niter:] + names[:self.niter] +
+                           nonseq_names)
         result, updates = theano.scan(
             fn=self.scan_fn,
             sequences=seqs,
             outputs_info=outputs,
             non_sequences=nonseqs,
             n_steps=n_steps,
+            truncate_gradient=truncate_gradient,
             go_backwards=reverse)
         result = tolist(result)
+        self.state_updates = OrderedDict()
+        for i, node in enumerate(self.recur_args.values()):
+            if getattr(node, 'persistent', 0) and outputs[i] is node.state:
+                self.state_updates[node.state] = result[i][-1]
         if self.output_args is None and self.iterators is None:
             return result
         if len(updates) == 0:
@@ -150,77 +375,191 @@ class Net(object):
             k.default_update = v
         return result[-self.nNone:], updates
 
+    def set_scan_plan(self, sources):
+        """
+        Execution plan of one step of scan
+
+        Each step of the plan holds the node, the slots of its
+        parents, the slots of its recurrent inputs in the previous
+        states and the index of its precomputed projection.
+
+        Parameters
+        ----------
+        sources : list of strings
+            Names of the sequences, then of the inputs fed back by
+            iterators, then of the non-sequence inputs, in the order
+            scan passes them
+        """
+        self.recur_slots = OrderedDict()
+        for i, nname in enumerate(self.recur_args.keys()):
+            self.recur_slots[nname] = i
+        proj_slots = dict((nname, i) for i, nname in
+                          enumerate(self.proj_args.keys()))
+        self.scan_plan = []
+        out_slots = {}
+        for nname, node, parents in self.get_plan(sources):
+            rec = None
+            if nname in self.recur_slots:
+                rec = [self.recur_slots[r] for r in node.recurrent]
+            self.scan_plan.append((nname, node, parents, rec,
+                                   proj_slots.get(nname)))
+            out_slots[nname] = len(sources) + len(out_slots)
+        self.out_slots = []
+        for args in [self.iterators, self.output_args]:
+            if args is None:
+                continue
+            for arg in args:
+                for nname, node in self.nodes.items():
+                    if node is arg:
+                        self.out_slots.append(out_slots[nname])
+
     def scan_fn(self, *args):
-        next_recurrence = []
-        sorted_nodes = topological_sort(self.graph)
-        inputs = tolist(args[:self.nseqs])
-        recurrence = tolist(args[self.nseqs:self.nseqs+self.nrecur])
-        inputs += tolist(args[self.nseqs+self.nrecur:self.nseqs+self.noutputs])
-        nonseqs = tolist(args[self.nseqs+self.noutputs:])
-        for nname, node in self.nodes.items():
-            for i, (aname, arg) in enumerate(self.recur_args.items()):
-                if node is arg:
-                    node.rec_out = recurrence[i]
-        if len(sorted_nodes) != 0:
-            for node in self.sorted_nodes:
-                inp = []
-                parent = self.nodes[node].parent
-                for par in parent:
-                    tok = 1
-                    for inp2 in inputs:
-                        if par in inp2.name:
-                            inp.append(inp2)
-                            tok = 0
-                            break
-                    if tok:
-                        inp.append(self.nodes[par].out)
-                if self.nodes[node] in self.recur_args.values():
-                    rec_inp = []
-                    recurrent = self.nodes[node].recurrent
-                    for rec in recurrent:
-                        rec_inp.append(self.nodes[rec].rec_out)
-                    inp = [inp, rec_inp]
-                    self.nodes[node].out = self.nodes[node].fprop(inp)
-                    next_recurrence.append(self.nodes[node].out)
+        nproj_start = self.nseqs - self.nprojs
+        values = list(args[:nproj_start])
+        projs = args[nproj_start:self.nseqs]
+        recurrence = args[self.nseqs:self.nseqs+self.nrecur]
+        # Inputs fed back by iterators and non-sequence inputs
+        # follow the recurrent states
+        values += args[self.nseqs+self.nrecur:
+                       self.nseqs+self.nrecur+self.nsources-nproj_start]
+        next_recurrence = [None] * self.nrecur
+        for nname, node, parents, rec, proj in self.scan_plan:
+            inp = [values[i] for i in parents]
+            if rec is not None:
+                rec_inp = [recurrence[i] for i in rec]
+                if proj is None:
+                    out = node.fprop([inp, rec_inp])
                 else:
-                    self.nodes[node].out = self.nodes[node].fprop(inp)
-        else:
-            # Assume that you have only single depth (parallel) graph
-            # Instead of Queue use for-loop to forcibly run the operation
-            for node in self.nodes:
-                inp = []
-                parent = self.nodes[node].parent
-                for par in parent:
-                    tok = 1
-                    for inp2 in inputs:
-                        if par in inp2.name:
-                            inp.append(inp2)
-                            tok = 0
-                            break
-                    if tok:
-                        inp.append(self.nodes[par].out)
-                if self.nodes[node] in self.recur_args.values():
-                    rec_inp = []
-                    recurrent = self.nodes[node].recurrent
-                    for rec in recurrent:
-                        rec_inp.append(self.nodes[rec].rec_out)
-                    inp = [inp, rec_inp]
-                    self.nodes[node].out = self.nodes[node].fprop(inp)
-                    next_recurrence.append(self.nodes[node].out)
-                else:
-                    self.nodes[node].out = self.nodes[node].fprop(inp)
-        required_outputs = []
-        if self.iterators is not None:
-            for arg in self.iterators:
-                for node in self.nodes.values():
-                    if node is arg:
-                        required_outputs.append(node.out)
-        if self.output_args is not None:
-            for arg in self.output_args:
-                for node in self.nodes.values():
-                    if node is arg:
-                        required_outputs.append(node.out)
-        return next_recurrence + required_outputs
+                    inp = [None if done else x for x, done in
+                           zip(inp, self.proj_args[nname])]
+                    out = node.fprop([inp, rec_inp], projs[proj])
+                next_recurrence[self.recur_slots[nname]] = out
+            else:
+                out = node.fprop(inp)
+            values.append(out)
+        return next_recurrence + [values[i] for i in self.out_slots]
+
+    def get_ancestors(self, outputs):
+        """
+        Names of the nodes the outputs depend on, outputs included
+
+        Recurrent nodes also depend on the nodes whose previous
+        states they read.
+
+        Parameters
+        ----------
+        outputs : list of nodes or node names
+        """
+        names = set()
+        stack = [getattr(out, 'name', out) for out in tolist(outputs)]
+        while stack:
+            nname = stack.pop()
+            if nname in names or nname not in self.nodes:
+                continue
+            names.add(nname)
+            node = self.nodes[nname]
+            stack.extend(node.parent.keys())
+            stack.extend(getattr(node, 'recurrent', {}).keys())
+        return names
+
+    def get_subnet(self, outputs):
+        """
+        Net restricted to the nodes and inputs the outputs
+        depend on
+
+        The nodes, and so their parameters, are shared with
+        this net rather than copied.
+
+        Parameters
+        ----------
+        outputs : list of nodes or node names
+        """
+        names = self.get_ancestors(outputs)
+        net = copy.copy(self)
+        net.nodes = dict((nname, node) for nname, node in self.nodes.items()
+                         if nname in names)
+        net.graph = {}
+        for par, children in self.graph.items():
+            children = [c for c in tolist(children) if c in names]
+            if par in names and len(children) > 0:
+                net.graph[par] = children
+        net.sorted_nodes = [nname for nname in self.sorted_nodes
+                            if nname in names]
+        read = set(flatten([node.parent.keys()
+                            for node in net.nodes.values()]))
+        net.inputs = OrderedDict((name, inp)
+                                 for name, inp in self.inputs.items()
+                                 if name in read)
+        net.params = net.get_params()
+        return net
+
+    def build_inference_graph(self, outputs, **kwargs):
+        """
+        Forward graph of the outputs only
+
+        Nodes the outputs do not depend on, such as cost layers
+        and KL terms, are not evaluated. Nodes with a set_mode,
+        such as dropout, batch normalization and NCE layers, are
+        built in test mode and switched back afterwards. Nets with
+        recurrent nodes are unrolled with build_recurrent_graph.
+
+        The outputs are returned rather than stored in node.out,
+        so the graph built for training is left as it was.
+
+        Parameters
+        ----------
+        outputs : list of nodes or node names
+        subnet  : Net
+            Result of get_subnet(outputs), computed when not given
+        kwargs  : passed to build_graph or build_recurrent_graph,
+            input indices refer to the inputs of get_subnet
+
+        Returns
+        -------
+        outs : list of TensorVariables, one per output
+        """
+        net = kwargs.pop('subnet', None)
+        if net is None:
+            net = self.get_subnet(outputs)
+        names = [getattr(out, 'name', out) for out in tolist(outputs)]
+        modes = OrderedDict()
+        for nname, node in net.nodes.items():
+            if hasattr(node, 'set_mode'):
+                modes[nname] = node.is_test
+                node.set_mode(1)
+        try:
+            if any(hasattr(node, 'get_init_state')
+                   for node in net.nodes.values()):
+                outs = net.build_recurrent_graph(
+                    output_args=[net.nodes[nname] for nname in names],
+                    **kwargs)
+                if isinstance(outs, tuple):
+                    outs = outs[0]
+                outs = tolist(outs)
+            else:
+                values = net.build_graph(set_out=0, **kwargs)
+                outs = [values[nname] for nname in names]
+        finally:
+            for nname, is_test in modes.items():
+                net.nodes[nname].set_mode(is_test)
+        return outs
+
+    def build_inference_fn(self, outputs, **kwargs):
+        """
+        Compile a forward-only function of the outputs
+
+        The arguments of the function are the inputs the outputs
+        depend on, in the order of self.inputs. No gradients and
+        no parameter updates are built.
+
+        Parameters
+        ----------
+        outputs : list of nodes or node names
+        kwargs  : see build_inference_graph
+        """
+        net = self.get_subnet(outputs)
+        outs = self.build_inference_graph(outputs, subnet=net, **kwargs)
+        return net.build_theano_graph(net.inputs.values(), outs)
 
     def get_params(self):
         return flatten([node.get_params().values()
@@ -6,7 +6,7 @@ import theano
 import theano.tensor as T
 
 from theano.compat.python2x import OrderedDict
-from cle.cle.cost import Gaussian, GMM, NllBin, NllMul, MSE
+from cle.cle.cost import Gaussian, GMM, NllBin, NllMul, NllMulInd, MSE
 from cle.cle.layers import RandomCell, StemCell
 from cle.cle.utils import sharedX, tolist, unpack, predict
 
@@ -53,10 +53,20 @@ class MulCrossEntropyLayer(CostLayer):
 
     Parameters
     ----------
-    .. todo::
+    use_index : bool
+        If True, the first parent holds integer labels
+        and log-probabilities are indexed directly
+        instead of going through one-hot targets
     """
+    def __init__(self, use_index=False, **kwargs):
+        super(MulCrossEntropyLayer, self).__init__(**kwargs)
+        self.use_index = use_index
+
     def fprop(self, X):
-        cost = NllMul(X[0], X[1])
+        if self.use_index:
+            cost = NllMulInd(X[0], X[1])
+        else:
+            cost = NllMul(X[0], X[1])
         if self.use_sum:
             return cost.sum()
         else:
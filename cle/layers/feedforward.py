@@ -14,14 +14,29 @@ class FullyConnectedLayer(StemCell):
     ----------
     .. todo::
     """
-    def fprop(self, X):
+    def fprop(self, X, z_in=None):
+        """
+        Parents given as None are skipped, their projection
+        is assumed to be in z_in already
+
+        Parameters
+        ----------
+        X    : list of TensorVariables or None
+        z_in : TensorVariable
+            Precomputed projection, without the bias
+        """
         if len(X) != len(self.parent):
             raise AttributeError("The number of inputs doesn't match "
                                  "with the number of parents.")
         # X could be a list of inputs.
         # depending the number of parents.
-        z = T.zeros((X[0].shape[0], self.nout))
+        if z_in is None:
+            z = T.zeros((X[0].shape[0], self.nout))
+        else:
+            z = z_in
         for x, (parname, parout) in izip(X, self.parent.items()):
+            if x is None:
+                continue
             W = self.params['W_'+parname+'__'+self.name]
             z += T.dot(x[:, :parout], W)
         z += self.params['b_'+self.name]
@@ -4,7 +4,7 @@ import theano
 import theano.tensor as T
 
 from cle.cle.layers import StemCell, InitCell
-from cle.cle.utils import tolist
+from cle.cle.utils import sharedX, tolist
 from itertools import izip
 from theano.compat.python2x import OrderedDict
 
@@ -15,6 +15,11 @@ class RecurrentLayer(StemCell):
 
     Parameters
     ----------
+    persistent : bool
+        Carry the last state of a batch over to the next one
+        through a shared buffer, for truncated BPTT on long
+        streams, see Training.reset_freq
+
     .. todo::
     """
     def __init__(self,
@@ -24,6 +29,7 @@ class RecurrentLayer(StemCell):
                  self_recurrent=1,
                  init_state_cons=0.,
                  init_U=InitCell('ortho'),
+                 persistent=0,
                  **kwargs):
         super(RecurrentLayer, self).__init__(**kwargs)
         self.recurrent = OrderedDict()
@@ -39,14 +45,91 @@ class RecurrentLayer(StemCell):
         self.init_U = init_U
         self.init_states = OrderedDict()
         self.init_state_cons = init_state_cons
+        self.persistent = persistent
+
+    def init_state_value(self, batch_size):
+        return np.zeros((batch_size, self.nout)) + self.init_state_cons
+
+    def persistent_state(self, batch_size=None):
+        """
+        Shared buffer holding the state carried between batches
+        """
+        if batch_size is None:
+            batch_size = self.batch_size
+        if getattr(self, 'state', None) is None:
+            self.state = sharedX(self.init_state_value(batch_size),
+                                 self.name+'_state')
+        return self.state
+
+    def reset_state(self):
+        if getattr(self, 'state', None) is not None:
+            batch_size = self.state.get_value().shape[0]
+            self.state.set_value(
+                self.init_state_value(batch_size).astype(self.state.dtype))
 
     def get_init_state(self, batch_size=None):
         if batch_size is None:
             batch_size = self.batch_size
+        if self.persistent:
+            return self.persistent_state(batch_size)
         state = T.zeros((batch_size, self.nout), dtype=theano.config.floatX) + self.init_state_cons
         state = T.unbroadcast(state, *range(state.ndim))
         return state
 
+    def project(self, X, z=None):
+        """
+        Input-to-hidden projection
+
+        X may hold whole sequences (time, batch, dim), so inputs
+        known up front are projected with one matrix product
+        outside scan and passed to fprop as z_in, which every
+        fprop hands back here as z. Parents given as None are
+        skipped, their projection is assumed to be in z already.
+
+        Parameters
+        ----------
+        X : list of TensorVariables or None
+        z : TensorVariable
+            Precomputed projection, the bias by default
+        """
+        if len(X) != len(self.parent):
+            raise AttributeError("The number of inputs doesn't match "
+                                 "with the number of parents.")
+        if z is None:
+            z = self.params['b_'+self.name]
+        for x, (parname, parout) in izip(X, self.parent.items()):
+            if x is None:
+                continue
+            W = self.params['W_'+parname+'__'+self.name]
+            x = x[(slice(None),) * (x.ndim - 1) + (slice(None, parout),)]
+            z += T.dot(x, W)
+        return z
+
+    def stack_recurrent(self, H):
+        """
+        Concatenate the recurrent states and their U blocks,
+        so that the recurrent term is a single product
+
+        Parameters
+        ----------
+        H : list of TensorVariables
+        """
+        Hs = []
+        Us = []
+        for h, (recname, recout) in izip(H, self.recurrent.items()):
+            Hs.append(h[:, :recout])
+            Us.append(self.params['U_'+recname+'__'+self.name])
+        if len(Hs) == 1:
+            return Hs[0], Us[0]
+        return T.concatenate(Hs, axis=1), T.concatenate(Us, axis=0)
+
+    def gate_index(self):
+        """
+        Column of the gate of each stacked recurrent unit
+        """
+        return np.repeat(np.arange(len(self.recurrent)),
+                         self.recurrent.values())
+
     def initialize(self):
         super(RecurrentLayer, self).initialize()
         for recname, recout in self.recurrent.items():
@@ -63,23 +146,15 @@ class SimpleRecurrent(RecurrentLayer):
     ----------
     .. todo::
     """
-    def fprop(self, XH):
+    def fprop(self, XH, z_in=None):
         # XH is a list of inputs: [state_belows, state_befores]
         X, H = XH
-        if len(X) != len(self.parent):
-            raise AttributeError("The number of inputs doesn't match "
-                                 "with the number of parents.")
         if len(H) != len(self.recurrent):
             raise AttributeError("The number of inputs doesn't match "
                                  "with the number of recurrents.")
-        z = T.zeros((X[0].shape[0], self.nout), dtype=theano.config.floatX)
-        for x, (parname, parout) in izip(X, self.parent.items()):
-            W = self.params['W_'+parname+'__'+self.name]
-            z += T.dot(x[:, :parout], W)
-        for h, (recname, recout) in izip(H, self.recurrent.items()):
-            U = self.params['U_'+recname+'__'+self.name]
-            z += T.dot(h[:, :recout], U)
-        z += self.params['b_'+self.name]
+        z = self.project(X, z_in)
+        h, U = self.stack_recurrent(H)
+        z += T.dot(h, U)
         z = self.nonlin(z)
         z.name = self.name
         return z
@@ -93,34 +168,31 @@ class LSTM(RecurrentLayer):
     ----------
     .. todo::
     """
+    def init_state_value(self, batch_size):
+        return np.zeros((batch_size, 2*self.nout))
+
     def get_init_state(self, batch_size=None):
         if batch_size is None:
             batch_size = self.batch_size
+        if self.persistent:
+            return self.persistent_state(batch_size)
         state = T.zeros((batch_size, 2*self.nout), dtype=theano.config.floatX)
         state = T.unbroadcast(state, *range(state.ndim))
         return state
 
-    def fprop(self, XH):
+    def fprop(self, XH, z_in=None):
         # XH is a list of inputs: [state_belows, state_befores]
         # each state vector is: [state_before; cell_before]
         # Hence, you use h[:, :self.nout] to compute recurrent term
         X, H = XH
-        if len(X) != len(self.parent):
-            raise AttributeError("The number of inputs doesn't match "
-                                 "with the number of parents.")
         if len(H) != len(self.recurrent):
             raise AttributeError("The number of inputs doesn't match "
                                  "with the number of recurrents.")
         # The index of self recurrence is 0
         z_t = H[0]
-        z = T.zeros((X[0].shape[0], 4*self.nout), dtype=theano.config.floatX)
-        for x, (parname, parout) in izip(X, self.parent.items()):
-            W = self.params['W_'+parname+'__'+self.name]
-            z += T.dot(x[:, :parout], W)
-        for h, (recname, recout) in izip(H, self.recurrent.items()):
-            U = self.params['U_'+recname+'__'+self.name]
-            z += T.dot(h[:, :recout], U)
-        z += self.params['b_'+self.name]
+        z = self.project(X, z_in)
+        h, U = self.stack_recurrent(H)
+        z += T.dot(h, U)
         # Compute activations of gating units
         i_on = T.nnet.sigmoid(z[:, self.nout:2*self.nout])
         f_on = T.nnet.sigmoid(z[:, 2*self.nout:3*self.nout])
@@ -163,42 +235,30 @@ class GFLSTM(LSTM):
     ----------
     .. todo::
     """
-    def fprop(self, XH):
+    def fprop(self, XH, z_in=None):
         # XH is a list of inputs: [state_belows, state_befores]
         # each state vector is: [state_before; cell_before]
         # Hence, you use h[:, :self.nout] to compute recurrent term
         X, H = XH
-        if len(X) != len(self.parent):
-            raise AttributeError("The number of inputs doesn't match "
-                                 "with the number of parents.")
         if len(H) != len(self.recurrent):
             raise AttributeError("The number of inputs doesn't match "
                                  "with the number of recurrents.")
         # The index of self recurrence is 0
         z_t = H[0]
-        Nm = len(self.recurrent)
-        z = T.zeros((X[0].shape[0], 4*self.nout+Nm), dtype=theano.config.floatX)
-        for x, (parname, parout) in izip(X, self.parent.items()):
-            W = self.params['W_'+parname+'__'+self.name]
-            z += T.dot(x[:, :parout], W)
-        for h, (recname, recout) in izip(H, self.recurrent.items()):
-            U = self.params['U_'+recname+'__'+self.name]
-            z = T.inc_subtensor(
-                z[:, self.nout:],
-                T.dot(h[:, :recout], U[:, self.nout:])
-            )
-        z += self.params['b_'+self.name]
+        z = self.project(X, z_in)
+        h, U = self.stack_recurrent(H)
+        z = T.inc_subtensor(
+            z[:, self.nout:],
+            T.dot(h, U[:, self.nout:])
+        )
         # Compute activations of gating units
         i_on = T.nnet.sigmoid(z[:, self.nout:2*self.nout])
         f_on = T.nnet.sigmoid(z[:, 2*self.nout:3*self.nout])
         o_on = T.nnet.sigmoid(z[:, 3*self.nout:4*self.nout])
         gron = T.nnet.sigmoid(z[:, 4*self.nout:])
         c_t = z[:, :self.nout]
-        for i, (h, (recname, recout)) in\
-            enumerate(izip(H, self.recurrent.items())):
-            gated_h = h[:, :recout] * gron[:, i].dimshuffle(0, 'x')
-            U = self.params['U_'+recname+'__'+self.name]
-            c_t += T.dot(gated_h, U[:, :self.nout])
+        # Each stacked unit is scaled by the gate of its recurrent
+        c_t += T.dot(h * gron[:, self.gate_index()], U[:, :self.nout])
         # Update hidden & cell states
         z_t = T.set_subtensor(
             z_t[:, self.nout:],
@@ -239,38 +299,27 @@ class GRU(RecurrentLayer):
     ----------
     .. todo::
     """
-    def fprop(self, XH):
+    def fprop(self, XH, z_in=None):
         # XH is a list of inputs: [state_belows, state_befores]
         # each state vector is: [state_before; cell_before]
         # Hence, you use h[:, :self.nout] to compute recurrent term
         X, H = XH
-        if len(X) != len(self.parent):
-            raise AttributeError("The number of inputs doesn't match "
-                                 "with the number of parents.")
         if len(H) != len(self.recurrent):
             raise AttributeError("The number of inputs doesn't match "
                                  "with the number of recurrents.")
         # The index of self recurrence is 0
         z_tm1 = H[0]
-        z = T.zeros((X[0].shape[0], 3*self.nout), dtype=theano.config.floatX)
-        for x, (parname, parout) in izip(X, self.parent.items()):
-            W = self.params['W_'+parname+'__'+self.name]
-            z += T.dot(x[:, :parout], W)
-        for h, (recname, recout) in izip(H, self.recurrent.items()):
-            U = self.params['U_'+recname+'__'+self.name]
-            z = T.inc_subtensor(
-                z[:, self.nout:],
-                T.dot(h[:, :recout], U[:, self.nout:])
-            )
-        z += self.params['b_'+self.name]
+        z = self.project(X, z_in)
+        h, U = self.stack_recurrent(H)
+        z = T.inc_subtensor(
+            z[:, self.nout:],
+            T.dot(h, U[:, self.nout:])
+        )
         # Compute activations of gating units
         r_on = T.nnet.sigmoid(z[:, self.nout:2*self.nout])
         u_on = T.nnet.sigmoid(z[:, 2*self.nout:])
         # Update hidden & cell states
-        c_t = T.zeros_like(z_tm1)
-        for h, (recname, recout) in izip(H, self.recurrent.items()):
-            U = self.params['U_'+recname+'__'+self.name]
-            c_t += T.dot(h[:, :recout], U[:, :self.nout])
+        c_t = T.dot(h, U[:, :self.nout])
         z_t = T.tanh(z[:, :self.nout] + r_on * c_t)
         z_t = u_on * z_tm1 + (1. - u_on) * z_t
         z_t.name = self.name
@@ -301,42 +350,29 @@ class GFGRU(GRU):
     ----------
     .. todo::
     """
-    def fprop(self, XH):
+    def fprop(self, XH, z_in=None):
         # XH is a list of inputs: [state_belows, state_befores]
         # each state vector is: [state_before; cell_before]
         # Hence, you use h[:, :self.nout] to compute recurrent term
         X, H = XH
-        if len(X) != len(self.parent):
-            raise AttributeError("The number of inputs doesn't match "
-                                 "with the number of parents.")
         if len(H) != len(self.recurrent):
             raise AttributeError("The number of inputs doesn't match "
                                  "with the number of recurrents.")
         # The index of self recurrence is 0
         z_tm1 = H[0]
-        Nm = len(self.recurrent)
-        z = T.zeros((X[0].shape[0], 3*self.nout+Nm), dtype=theano.config.floatX)
-        for x, (parname, parout) in izip(X, self.parent.items()):
-            W = self.params['W_'+parname+'__'+self.name]
-            z += T.dot(x[:, :parout], W)
-        for h, (recname, recout) in izip(H, self.recurrent.items()):
-            U = self.params['U_'+recname+'__'+self.name]
-            z = T.inc_subtensor(
-                z[:, self.nout:],
-                T.dot(h[:, :recout], U[:, self.nout:])
-            )
-        z += self.params['b_'+self.name]
+        z = self.project(X, z_in)
+        h, U = self.stack_recurrent(H)
+        z = T.inc_subtensor(
+            z[:, self.nout:],
+            T.dot(h, U[:, self.nout:])
+        )
         # Compute activations of gating units
         r_on = T.nnet.sigmoid(z[:, self.nout:2*self.nout])
         u_on = T.nnet.sigmoid(z[:, 2*self.nout:3*self.nout])
         gron = T.nnet.sigmoid(z[:, 3*self.nout:])
         # Update hidden & cell states
-        c_t = T.zeros_like(z_tm1)
-        for i, (h, (recname, recout)) in\
-            enumerate(izip(H, self.recurrent.items())):
-            gated_h = h[:, :recout] * gron[:, i].dimshuffle(0, 'x')
-            U = self.params['U_'+recname+'__'+self.name]
-            c_t += T.dot(gated_h, U[:, :self.nout])
+        # Each stacked unit is scaled by the gate of its recurrent
+        c_t = T.dot(h * gron[:, self.gate_index()], U[:, :self.nout])
         z_t = T.tanh(z[:, :self.nout] + r_on * c_t)
         z_t = u_on * z_tm1 + (1. - u_on) * z_t
         z_t.name = self.name
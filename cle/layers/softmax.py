@@ -0,0 +1,270 @@
+import ipdb
+import numpy as np
+import theano
+import theano.tensor as T
+
+from cle.cle.layers import InitCell
+from cle.cle.layers.cost import CostLayer
+from itertools import izip
+from theano.tensor.nnet.blocksparse import sparse_block_dot
+
+
+class ClassSoftmaxLayer(CostLayer):
+    """
+    Two-level class-factored softmax layer
+
+    Word w belongs to class c(w) = w // csize and
+    p(w|h) = p(c(w)|h) p(w|c(w), h), so training only
+    touches the nclass class logits and the csize word logits
+    of the target's class. With a vocabulary sorted by
+    frequency, classes are frequency bins.
+
+    The first parent holds integer labels, the remaining
+    parents are the hidden inputs.
+
+    Parameters
+    ----------
+    nclass : int
+        Number of classes, sqrt(nout) by default
+    """
+    def __init__(self, nclass=None, **kwargs):
+        super(ClassSoftmaxLayer, self).__init__(**kwargs)
+        if nclass is None:
+            nclass = int(np.ceil(np.sqrt(self.nout)))
+        self.nclass = nclass
+        self.csize = -(-self.nout // nclass)
+
+    def initialize(self):
+        for parname, parout in self.parent.items()[1:]:
+            W_shape = (parout, self.nclass)
+            W_name = 'W_'+parname+'__'+self.name+'_class'
+            self.alloc(self.init_W.get(W_shape, W_name))
+            W_shape = (parout, self.nclass * self.csize)
+            W_name = 'W_'+parname+'__'+self.name
+            self.alloc(self.init_W.get(W_shape, W_name))
+        self.alloc(self.init_b.get(self.nclass, 'b_'+self.name+'_class'))
+        self.alloc(self.init_b.get(self.nclass * self.csize, 'b_'+self.name))
+
+    def word_bias(self):
+        b = self.params['b_'+self.name]
+        npad = self.nclass * self.csize - self.nout
+        if npad:
+            # Padding slots of the last class never get any mass
+            mask = np.zeros(self.nclass * self.csize, dtype=b.dtype)
+            mask[-npad:] = -1e8
+            b = b + mask
+        return b
+
+    def class_logits(self, H):
+        z = self.params['b_'+self.name+'_class']
+        for h, (parname, parout) in izip(H, self.parent.items()[1:]):
+            W = self.params['W_'+parname+'__'+self.name+'_class']
+            z += T.dot(h[:, :parout], W)
+        return z
+
+    def fprop(self, X):
+        if len(X) != len(self.parent):
+            raise AttributeError("The number of inputs doesn't match "
+                                 "with the number of parents.")
+        y = T.cast(X[0].flatten(), 'int32')
+        H = X[1:]
+        rows = T.arange(y.shape[0])
+        c = y // self.csize
+        class_p = T.nnet.softmax(self.class_logits(H))
+        # Block-sparse product against the target class's W block,
+        # nothing of size batch x hidden x csize is materialized
+        b = self.word_bias().reshape((self.nclass, self.csize))
+        in_idx = T.zeros_like(c).dimshuffle(0, 'x')
+        out_idx = c.dimshuffle(0, 'x')
+        z = 0.
+        for h, (parname, parout) in izip(H, self.parent.items()[1:]):
+            W = self.params['W_'+parname+'__'+self.name]
+            W = W.reshape((parout, self.nclass, self.csize))
+            z += sparse_block_dot(W.dimshuffle('x', 1, 0, 2),
+                                  h[:, :parout].dimshuffle(0, 'x', 1),
+                                  in_idx, b, out_idx)[:, 0]
+            # The bias is added by the first product only
+            b = T.zeros_like(b)
+        word_p = T.nnet.softmax(z)
+        cost = -T.log(class_p[rows, c]) - T.log(word_p[rows, y % self.csize])
+        if self.use_sum:
+            return cost.sum()
+        else:
+            return cost.mean()
+
+    def prob(self, X):
+        """
+        Exact distribution over the whole vocabulary
+
+        Parameters
+        ----------
+        X : list
+            Same inputs as fprop, the labels are not used
+        """
+        H = X[1:]
+        class_p = T.nnet.softmax(self.class_logits(H))
+        z = self.word_bias()
+        for h, (parname, parout) in izip(H, self.parent.items()[1:]):
+            W = self.params['W_'+parname+'__'+self.name]
+            z += T.dot(h[:, :parout], W)
+        word_p = T.nnet.softmax(z.reshape((-1, self.csize)))
+        p = word_p.reshape((-1, self.nclass, self.csize)) *\
+            class_p.dimshuffle(0, 1, 'x')
+        p = p.reshape((p.shape[0], -1))[:, :self.nout]
+        p.name = self.name
+        return p
+
+
+class NCELayer(CostLayer):
+    """
+    Noise-contrastive estimation output layer
+
+    In training mode, the target logit is discriminated from nsample
+    noise words shared across the batch, assuming a self-normalized
+    softmax. In test mode, the exact negative log-likelihood of
+    the full softmax is returned.
+
+    The first parent holds integer labels, the remaining
+    parents are the hidden inputs.
+
+    Parameters
+    ----------
+    nsample : int
+        Number of noise words per update
+    noise   : string
+        'uniform' or 'log_uniform', the latter being Zipfian
+        for a vocabulary sorted by frequency
+    """
+    def __init__(self,
+                 nsample=100,
+                 noise='log_uniform',
+                 is_test=0,
+                 **kwargs):
+        super(NCELayer, self).__init__(**kwargs)
+        if noise not in ('uniform', 'log_uniform'):
+            raise ValueError("noise should be 'uniform' or 'log_uniform'.")
+        self.nsample = nsample
+        self.noise = noise
+        self.is_test = is_test
+        self.set_mode(self.is_test)
+
+    def set_mode(self, is_test=0):
+        self.is_test = is_test
+        if self.is_test:
+            self.fprop = self.which_fn('test_prop')
+        else:
+            self.fprop = self.which_fn('train_prop')
+
+    def initialize(self):
+        for parname, parout in self.parent.items()[1:]:
+            W_shape = (parout, self.nout)
+            W_name = 'W_'+parname+'__'+self.name
+            self.alloc(self.init_W.get(W_shape, W_name))
+        self.alloc(self.init_b.get(self.nout, 'b_'+self.name))
+
+    def logits(self, H, idx=None):
+        z = self.params['b_'+self.name]
+        if idx is not None:
+            z = z[idx]
+        for h, (parname, parout) in izip(H, self.parent.items()[1:]):
+            W = self.params['W_'+parname+'__'+self.name]
+            if idx is not None:
+                W = W.T[idx].T
+            z += T.dot(h[:, :parout], W)
+        return z
+
+    def log_noise(self, idx):
+        if self.noise == 'uniform':
+            return T.zeros_like(idx).astype(theano.config.floatX) -\
+                np.log(self.nout)
+        idx = T.cast(idx, theano.config.floatX)
+        return T.log(T.log((idx + 2.) / (idx + 1.)) / np.log(self.nout + 1.))
+
+    def sample_noise(self):
+        u = self.theano_rng.uniform(size=(self.nsample,),
+                                    dtype=theano.config.floatX)
+        if self.noise == 'uniform':
+            idx = T.floor(u * self.nout)
+        else:
+            idx = T.floor(T.exp(u * np.log(self.nout + 1.))) - 1
+        return T.cast(T.clip(idx, 0, self.nout - 1), 'int32')
+
+    def train_prop(self, X):
+        if len(X) != len(self.parent):
+            raise AttributeError("The number of inputs doesn't match "
+                                 "with the number of parents.")
+        y = T.cast(X[0].flatten(), 'int32')
+        H = X[1:]
+        idx = self.sample_noise()
+        log_k = np.log(self.nsample)
+        z_y = self.params['b_'+self.name][y]
+        for h, (parname, parout) in izip(H, self.parent.items()[1:]):
+            W = self.params['W_'+parname+'__'+self.name]
+            z_y += (h[:, :parout] * W.T[y]).sum(axis=1)
+        z_n = self.logits(H, idx)
+        cost = T.nnet.softplus(-(z_y - log_k - self.log_noise(y))) +\
+            T.nnet.softplus(z_n - log_k -
+                            self.log_noise(idx).dimshuffle('x', 0)).sum(axis=1)
+        if self.use_sum:
+            return cost.sum()
+        else:
+            return cost.mean()
+
+    def test_prop(self, X):
+        if len(X) != len(self.parent):
+            raise AttributeError("The number of inputs doesn't match "
+                                 "with the number of parents.")
+        y = T.cast(X[0].flatten(), 'int32')
+        p = self.prob(X)
+        cost = -T.log(p[T.arange(y.shape[0]), y])
+        if self.use_sum:
+            return cost.sum()
+        else:
+            return cost.mean()
+
+    def prob(self, X):
+        """
+        Exact distribution over the whole vocabulary
+
+        Parameters
+        ----------
+        X : list
+            Same inputs as fprop, the labels are not used
+        """
+        p = T.nnet.softmax(self.logits(X[1:]))
+        p.name = self.name
+        return p
+
+    def __getstate__(self):
+        dic = self.__dict__.copy()
+        dic.pop('fprop')
+        return dic
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.set_mode(self.is_test)
+
+
+if __name__ == "__main__":
+    # The class-factored NLL of fprop should match the exact
+    # distribution of prob on a small vocabulary
+    nout, nhid, batch_size = 10, 4, 7
+    y = T.imatrix('y')
+    h = T.matrix('h')
+    layer = ClassSoftmaxLayer(name='softmax',
+                              parent=['y', 'h'],
+                              parent_dim=[1, nhid],
+                              nout=nout,
+                              nclass=3,
+                              init_W=InitCell('randn', stddev=1.),
+                              init_b=InitCell('randn', stddev=1.),
+                              use_sum=True)
+    layer.initialize()
+    p = layer.prob([y, h])
+    nll = -T.log(p[T.arange(y.shape[0]), y.flatten()]).sum()
+    f = theano.function([y, h], [layer.fprop([y, h]), nll],
+                        on_unused_input='ignore')
+    y_val = np.random.randint(nout, size=(batch_size, 1)).astype('int32')
+    h_val = np.random.normal(size=(batch_size, nhid))
+    cost, exact = f(y_val, h_val.astype(theano.config.floatX))
+    assert np.allclose(cost, exact, rtol=1e-4), (cost, exact)
@@ -41,6 +41,16 @@ class Model(object):
             params += graph.params
         return params
 
+    def get_persistent(self):
+        """
+        Recurrent nodes carrying their state between batches
+        """
+        nodes = list(tolist(self.nodes)) if self.nodes is not None else []
+        for graph in tolist(self.graphs):
+            if graph is not None:
+                nodes += graph.nodes.values()
+        return [node for node in nodes if getattr(node, 'persistent', 0)]
+
     def set_updates(self, updates):
         for update in updates:
             self.updates[update] = update
@@ -18,6 +18,21 @@ class Training(PickleMixin, TheanoMixin):
 
     Parameters
     ----------
+    reset_freq     : int
+        Reset the state of persistent recurrent layers every
+        reset_freq batches, 0 for only at the start of each epoch.
+        Their state buffers hold a fixed number of rows, so data
+        feeding them must not emit batches of another size
+    function_cache : str
+        Directory of compiled functions, see TheanoMixin. When set,
+        the training function and the functions of the extensions
+        are compiled in parallel worker processes
+
+    Notes
+    -----
+    Functions are compiled lazily, the training function when
+    the main loop starts and the others on their first call.
+
     .. todo::
     """
     def __init__(self,
@@ -29,7 +44,9 @@ class Training(PickleMixin, TheanoMixin):
                  outputs,
                  debug_print=0,
                  trainlog=None,
-                 extension=None):
+                 extension=None,
+                 reset_freq=0,
+                 function_cache=None):
         self.name = name
         self.data = data
         self.model = model
@@ -41,13 +58,18 @@ class Training(PickleMixin, TheanoMixin):
         self.updates = model.updates
         self.extension = extension
         self.debug_print = debug_print
+        self.reset_freq = reset_freq
+        self.function_cache = function_cache
+        for graph in tolist(model.graphs):
+            if graph is not None:
+                self.updates.update(getattr(graph, 'state_updates', {}))
+        self.check_batch_size(self.data)
 
-        t0 = time.time()
         self.cost_fn = self.build_training_graph()
-        print "Elapsed compilation time: %f" % (time.time() - t0)
-        if self.debug_print:
-            from theano.printing import debugprint
-            debugprint(self.cost_fn)
+        for ext in tolist(self.extension):
+            if hasattr(ext, 'prepare'):
+                ext.prepare(self)
+        self.cost_fn.start()
         if trainlog is None:
             self.trainlog = TrainLog()
         else:
@@ -63,16 +85,27 @@ class Training(PickleMixin, TheanoMixin):
         for key, val in grads.items():
             self.updates[key] = val
         self.run_extension('ext_regularize_post_grad')
-        return self.build_theano_graph(self.inputs, self.outputs, self.updates)
+        return self.build_lazy_graph(self.inputs, self.outputs, self.updates)
+
+    def compile(self):
+        t0 = time.time()
+        self.cost_fn.compile()
+        print "Elapsed compilation time: %f" % (time.time() - t0)
+        if self.debug_print:
+            from theano.printing import debugprint
+            debugprint(self.cost_fn.fn)
 
     def run(self):
+        self.compile()
         logger.info("Entering main loop")
         while self.run_epoch():
             pass
         logger.info("Terminating main loop")
 
     def run_epoch(self):
-        for batch in self.data:
+        for i, batch in enumerate(self.data):
+            if i == 0 or (self.reset_freq and i % self.reset_freq == 0):
+                self.reset_states()
             self.run_extension('ext_monitor')
             batch_t0 = time.time()
             this_cost = self.cost_fn(*batch)
@@ -86,6 +119,37 @@ class Training(PickleMixin, TheanoMixin):
             return False
         return True
 
+    def reset_states(self):
+        for node in self.model.get_persistent():
+            node.reset_state()
+
+    def check_batch_size(self, data):
+        """
+        Make sure the batches of data fit the state buffers
+        of the persistent recurrent layers
+
+        Parameters
+        ----------
+        data : Iterator
+        """
+        use_partial = getattr(data, 'use_partial', 0)
+        batch_size = getattr(data, 'batch_size', None)
+        # Each bucket of a sampler may end with a short batch
+        sampler_partial = getattr(getattr(data, 'sampler', None),
+                                  'use_partial', 0)
+        for node in self.model.get_persistent():
+            nrow = node.persistent_state().get_value(borrow=True).shape[0]
+            if sampler_partial or\
+                    use_partial and (hasattr(data.data, 'stream') or
+                                     data.nexp % data.batch_size):
+                raise ValueError("Layer %s carries its state between "
+                                 "batches and cannot be fed partial "
+                                 "batches, set use_partial=0." % node.name)
+            if batch_size is not None and batch_size != nrow:
+                raise ValueError("Layer %s carries a state of %d rows, "
+                                 "got batches of %d." %
+                                 (node.name, nrow, batch_size))
+
     def find_extension(self, name):
         try:
             exts = [extension for extension in self.extension
@@ -96,8 +96,18 @@ class EpochCount(Extension):
 
 
 class Monitoring(Extension, TheanoMixin):
-    def __init__(self, freq, ddout=None, data=None, monitor_fn=None):
+    def __init__(self, freq, ddout=None, data=None, monitor_fn=None,
+                 reset_state=1):
         """
+        Parameters
+        ----------
+        reset_state : bool
+            Persistent recurrent layers start every monitoring batch
+            from their initial state, and the training state is put
+            back afterwards. With 0, monitoring starts from the state
+            carried by the training stream. Monitoring never updates
+            the state either way.
+
         .. todo::
 
             WRITEME
@@ -107,6 +117,23 @@ class Monitoring(Extension, TheanoMixin):
         self.ddout = ddout
         self.data = data
         self.monitor_fn = monitor_fn
+        self.reset_state = reset_state
+
+    def prepare(self, mainloop):
+        """
+        Start compiling the monitoring function alongside
+        the training function
+        """
+        if self.monitor_fn is None and self.ddout is not None:
+            if self.function_cache is None:
+                self.function_cache = getattr(mainloop, 'function_cache',
+                                              None)
+            self.monitor_fn = self.build_lazy_graph(mainloop.inputs,
+                                                    self.ddout)
+            self.monitor_fn.start()
+        if self.data is not None:
+            for data in self.data:
+                mainloop.check_batch_size(data)
 
     def monitor_data_based_channels(self, mainloop):
         """
@@ -115,9 +142,12 @@ class Monitoring(Extension, TheanoMixin):
             WRITEME
         """
         if self.monitor_fn is None:
-            inputs = mainloop.inputs
-            self.monitor_fn = self.build_theano_graph(inputs, self.ddout)
+            self.prepare(mainloop)
         if self.data is not None:
+            persistent = mainloop.model.get_persistent()
+            states = [node.state.get_value() for node in persistent]
+            if self.reset_state:
+                mainloop.reset_states()
             data_record = []
             for data in self.data:
                 batch_record = []
@@ -125,6 +155,8 @@ class Monitoring(Extension, TheanoMixin):
                     this_out = self.monitor_fn(*batch)
                     batch_record.append(this_out)
                 data_record.append(np.asarray(batch_record))
+            for node, state in zip(persistent, states):
+                node.state.set_value(state)
             this_ch = []
             for record, data in zip(data_record, self.data):
                 for i, ch in enumerate(self.ddout):
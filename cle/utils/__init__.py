@@ -50,10 +50,10 @@ def topological_sort(graph):
 
 
 def one_hot(labels, nlabels=None):
+    labels = np.asarray(labels).ravel()
     nlabels = np.max(labels) + 1 if nlabels is None else nlabels
     code = np.zeros((len(labels), nlabels), dtype='float32')
-    for i, j in enumerate(labels):
-        code[i, j] = 1.
+    code[np.arange(len(labels)), labels] = 1.
     return code
 
 
@@ -24,6 +24,68 @@ def add_noise(x, stddev, theano_rng):
     return x
 
 
+def overlap_add(frames, overlap):
+    """
+    Sum frames shifted by overlap samples
+
+    Frames are zero padded to a multiple of overlap so that each
+    frame splits into K blocks of overlap samples; output block b
+    is then the sum of block k of frame b - k over k. Blocks are
+    accumulated from the earliest frame on, in float32, so the
+    result is the same as adding the frames one by one.
+
+    Parameters
+    ----------
+    frames  : ndArray
+        (..., timesteps, frame_size)
+    overlap : amount of overlap (usually half of the window size)
+    """
+    frames = np.asarray(frames)
+    lead = frames.shape[:-2]
+    timesteps, frame_size = frames.shape[-2:]
+    K = -(-frame_size // overlap)
+    padded = np.zeros(lead + (timesteps, K * overlap), dtype=frames.dtype)
+    padded[..., :frame_size] = frames
+    padded = padded.reshape(lead + (timesteps, K, overlap))
+    new_x = np.zeros(lead + (timesteps + K - 1, overlap), dtype=np.float32)
+    for k in xrange(K - 1, -1, -1):
+        new_x[..., k:k+timesteps, :] += padded[..., k, :]
+    new_x = new_x.reshape(lead + ((timesteps + K - 1) * overlap,))
+    return new_x[..., :frame_size + (timesteps - 1) * overlap]
+
+
+w_sums = {}
+
+
+def window_sum(frame_size, overlap, timesteps, clip=0):
+    """
+    Hann window and its overlap-added square, cached per
+    (frame_size, overlap, timesteps)
+
+    Parameters
+    ----------
+    frame_size : integer
+    overlap    : amount of overlap (usually half of the window size)
+    timesteps  : integer
+    clip       : bool
+        Use the window clipped at 1e-4 of batch_overlap_sum
+        instead of flooring the sum at 0.01 as overlap_sum does
+    """
+    key = (frame_size, overlap, timesteps, clip)
+    if key not in w_sums:
+        import scipy.signal
+        w = scipy.signal.hann(frame_size)
+        if clip:
+            w = np.maximum(w, 1e-4)
+        w_sum = overlap_add(np.ones((timesteps, 1)) * w**2, overlap)
+        if not clip:
+            w_sum = np.maximum(w_sum, 0.01)
+        w.flags.writeable = False
+        w_sum.flags.writeable = False
+        w_sums[key] = (w, w_sum)
+    return w_sums[key]
+
+
 def overlap_sum(X, overlap):
     """
     WRITEME
@@ -37,20 +99,10 @@ def overlap_sum(X, overlap):
     -----
     This function assumes X as a matrix form of a sequence
     """
-    timesteps, frame_size = np.array(X).shape
-    new_x = np.zeros(frame_size + (timesteps - 1) * overlap,
-                     dtype=np.float32)
-    import scipy
-    w = scipy.signal.hann(frame_size)
-    w2 = w**2
-    w_sum = np.zeros(frame_size + (timesteps - 1) * overlap,
-                     dtype=np.float32)
-    start = 0
-    for i in xrange(timesteps):
-        new_x[start:start+frame_size] += X[i] * w
-        w_sum[start:start+frame_size] += w2
-        start += overlap
-    w_sum = np.maximum(w_sum, 0.01)
+    X = np.asarray(X)
+    timesteps, frame_size = X.shape
+    w, w_sum = window_sum(frame_size, overlap, timesteps)
+    new_x = overlap_add(X * w, overlap)
     new_x /= w_sum
     return new_x
 
@@ -66,30 +118,17 @@ def batch_overlap_sum(X, overlap):
 
     Notes
     -----
-    This function assumes X as 3D
+    This function assumes X as 3D, all sequences are
+    overlap-added at once
     """
-    new_X = []
-    timesteps, frame_size = np.array(X[0]).shape
-    import scipy
-    w = np.maximum(scipy.signal.hann(frame_size), 1e-4)
-    w2 = w**2
-    w_sum = np.zeros(frame_size + (timesteps - 1) * overlap,
-                     dtype=np.float32)
-    start = 0
-    for i in xrange(timesteps):
-        w_sum[start:start+frame_size] += w2
-        start += overlap
-    for i in xrange(len(X)):
-        timesteps, frame_size = np.array(X[i]).shape
-        new_x = np.zeros(frame_size + (timesteps - 1) * overlap,
-                         dtype=np.float32)
-        start = 0
-        for j in xrange(timesteps):
-            new_x[start:start+frame_size] += X[i][j] * w
-            start += overlap
-        new_x /= w_sum
-        new_X.append(new_x)
-    return np.array(new_X)
+    X = np.asarray(X)
+    if X.dtype == object:
+        return np.array([batch_overlap_sum([x], overlap)[0] for x in X])
+    timesteps, frame_size = X.shape[-2:]
+    w, w_sum = window_sum(frame_size, overlap, timesteps, clip=1)
+    new_X = overlap_add(X * w, overlap)
+    new_X /= w_sum
+    return new_X
 
 
 def complex_to_real(X):
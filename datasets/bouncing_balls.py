@@ -15,7 +15,7 @@ class BouncingBalls(TemporalSeries):
     .. todo::
     """
     def load(self, path):
-        data = np.load(path)
+        data = np.load(path, mmap_mode=self.mmap_mode)
         X = data[:, :-1, :]
         y = data[:, 1:, :]
         return (X, y)
@@ -14,8 +14,8 @@ class CIFAR10(DesignMatrix):
     .. todo::
     """
     def load(self, path):
-        X = np.load(path[0])
-        y = np.load(path[1])
+        X = np.load(path[0], mmap_mode=self.mmap_mode)
+        y = np.load(path[1], mmap_mode=self.mmap_mode)
         return (X, y)
 
     def theano_vars(self):
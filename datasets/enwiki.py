@@ -3,19 +3,31 @@ import os
 import numpy as np
 import theano.tensor as T
 
+from numpy.lib.stride_tricks import as_strided
 from cle.cle.data import TemporalSeries
 from cle.cle.data.prep import SequentialPrepMixin
-from cle.cle.utils import segment_axis, tolist, totuple
+from cle.cle.utils import segment_axis
 
 
 class EnWiki(TemporalSeries, SequentialPrepMixin):
     """
     English Wikipedia dataset batch provider
 
+    The text is split into batch_size parallel streams, and example
+    k = i * batch_size + b is the i-th context window of stream b.
+    X and y are strided views over the single text array,
+    stored as (windows, batch_size, context_len, 1). Batches are
+    time-major (context_len, batch, 1) like other TemporalSeries, so
+    a batch of window i continues the streams of window i - 1.
+
     Parameters
     ----------
     .. todo::
     """
+    # The raw text is cached and windowed on load, so batch_size
+    # and context_len do not change the cache entry
+    cache_params = ['data_mode']
+
     def __init__(self, data_mode='chars', batch_size=100, context_len=100, **kwargs):
         self.data_mode = data_mode
         self.batch_size = batch_size
@@ -23,7 +35,13 @@ class EnWiki(TemporalSeries, SequentialPrepMixin):
         super(EnWiki, self).__init__(**kwargs)
 
     def load(self, data_path):
-        data = np.load(data_path)
+        if self.mmap_mode is None:
+            data = np.load(data_path)
+        else:
+            keys = ['%s_%s' % (self.name, self.data_mode)]
+            if self.data_mode == 'words':
+                keys.append('n_words')
+            data = self.mmap_load(data_path, keys)
         if self.data_mode == 'words':
             if self.name == 'train':
                 raw_data = data['train_words']
@@ -39,30 +57,52 @@ class EnWiki(TemporalSeries, SequentialPrepMixin):
                 raw_data = data['valid_chars']
             elif self.name == 'test':
                 raw_data = data['test_chars']
+        return self.windows(raw_data)
+
+    def windows(self, raw_data):
+        self.raw_data = raw_data
         chunk_size = len(raw_data) / self.batch_size
         raw_data = segment_axis(raw_data, chunk_size, 0)
-
-        X = []
-        y = []
-        for i in range(int(np.float((raw_data.shape[1] - 1) /
-                           float(self.context_len)))):
-            X.extend(raw_data[:, :-1][:, i * self.context_len:(i + 1) * self.context_len,
-                                      np.newaxis])
-            y.extend(raw_data[:, 1:][:, i * self.context_len:(i + 1) * self.context_len,
-                                     np.newaxis])
-        X = np.asarray(X)
-        y = np.asarray(y)
+        nwin = int(np.float((raw_data.shape[1] - 1) /
+                            float(self.context_len)))
+        s0, s1 = raw_data.strides
+        shape = (nwin, self.batch_size, self.context_len, 1)
+        strides = (self.context_len * s1, s0, s1, s1)
+        X = as_strided(raw_data, shape, strides)
+        y = as_strided(raw_data[:, 1:], shape, strides)
         return [X, y]
 
+    def num_examples(self):
+        return self.data[0].shape[0] * self.data[0].shape[1]
+
+    def to_arrays(self, data):
+        arrays = {'raw_data': self.raw_data}
+        if self.data_mode == 'words':
+            arrays['n_words'] = np.asarray(self._max_labels)
+        return arrays
+
+    def from_arrays(self, arrays):
+        if self.data_mode == 'words':
+            self._max_labels = int(arrays['n_words'])
+        return self.windows(arrays['raw_data'])
+
     def theano_vars(self):
         return [T.ftensor3('x'), T.ftensor3('y')]
 
     def test_theano_vars(self):
         return [T.fmatrix('x')]
 
-    def slices(self, start, end):
-        batches = [mat[start:end] for mat in self.data]
-        return totuple(batches)
+    def slices(self, start, end, out=None):
+        i, b = divmod(start, self.batch_size)
+        if end - start > self.batch_size - b:
+            # Crosses a window boundary, no single view covers it
+            return self.take(np.arange(start, end), out)
+        return tuple(mat[i, b:b + end - start].swapaxes(0, 1)
+                     for mat in self.data)
+
+    def take(self, idx, out=None):
+        i, b = idx // self.batch_size, idx % self.batch_size
+        return tuple(mat[i, b].swapaxes(0, 1) for mat in self.data)
 
 
 if __name__ == "__main__":
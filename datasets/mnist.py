@@ -19,6 +19,10 @@ class MNIST(DesignMatrix):
             self.data = [self.data[0]]
 
     def load(self, path):
+        if self.mmap_mode is not None:
+            keys = [self.name + '_x', self.name + '_y']
+            data = self.mmap_load(path, keys)
+            return [data[key] for key in keys]
         data = np.load(path)
         if self.name == 'train':
             return data[0]
@@ -27,5 +31,13 @@ class MNIST(DesignMatrix):
         elif self.name == 'test':
             return data[2]
 
+    def unpack(self, path):
+        data = np.load(path)
+        arrays = {}
+        for i, which in enumerate(['train', 'valid', 'test']):
+            arrays[which + '_x'] = data[i][0]
+            arrays[which + '_y'] = data[i][1]
+        return arrays
+
     def theano_vars(self):
         return [T.fmatrix('x'), T.lvector('y')]
@@ -2,27 +2,39 @@ import ipdb
 import numpy as np
 import theano.tensor as T
 
-from cle.cle.data import TemporalSeries
-from cle.cle.utils import tolist, totuple
+from itertools import chain
+from cle.cle.data import (
+    RaggedArray,
+    TemporalSeries,
+    ragged_arange,
+    reuse_buffer
+)
 
 
 class Music(TemporalSeries):
     """
     Music datasets batch provider
 
+    Timesteps are stored packed in a RaggedArray,
+    either as dense piano-rolls or, if sparse, as the note indices
+    from which the one-hot batches are built on the fly.
+
     Parameters
     ----------
     .. todo::
     """
-    def __init__(self, nlabel, **kwargs):
+    cache_params = ['nlabel', 'sparse']
+
+    def __init__(self, nlabel, sparse=1, **kwargs):
         self.nlabel = nlabel
+        self.sparse = sparse
         super(Music, self).__init__(**kwargs)
 
-    def slices(self, start, end):
-        batches = [mat[start:end] for mat in self.data]
-        mask = tolist(self.create_mask(batches[0].swapaxes(0, 1)))
-        batches = [self.zero_pad(batch) for batch in batches]
-        return totuple(batches + mask)
+    def slices(self, start, end, out=None):
+        return self.pad_batch([mat[start:end] for mat in self.data], out)
+
+    def take(self, idx, out=None):
+        return self.pad_batch(self.gather(idx, out), out)
 
     def load(self, path):
         data = np.load(path)
@@ -32,19 +44,65 @@ class Music(TemporalSeries):
             data = data['valid']
         elif self.name == 'test':
             data = data['test']
-        X = np.asarray(
-            [np.asarray([self.list2nparray(ts, self.nlabel)
-             for ts in np.asarray(d[:-1])]) for d in data])
-        y = np.asarray(
-            [np.asarray([self.list2nparray(ts, self.nlabel)
-             for ts in np.asarray(d[1:])]) for d in data])
+        seq_len = np.array([len(d) for d in data])
+        step_len = np.array([len(ts) for d in data for ts in d])
+        notes = np.fromiter(chain.from_iterable(chain.from_iterable(data)),
+                            dtype=np.int32, count=step_len.sum()) - 1
+        if self.sparse:
+            steps = RaggedArray(notes, np.cumsum(step_len) - step_len,
+                                step_len)
+        else:
+            steps = np.zeros((len(step_len), self.nlabel), dtype=np.float32)
+            steps[np.repeat(np.arange(len(step_len)), step_len), notes] = 1
+        starts = np.cumsum(seq_len) - seq_len
+        X = RaggedArray(steps, starts, seq_len - 1)
+        y = RaggedArray(steps, starts + 1, seq_len - 1)
+        return (X, y)
+
+    def to_arrays(self, data):
+        X, y = data
+        arrays = {'starts': X.starts, 'lengths': X.lengths}
+        if self.sparse:
+            arrays['notes'] = X.values.values
+            arrays['step_starts'] = X.values.starts
+            arrays['step_lengths'] = X.values.lengths
+        else:
+            arrays['steps'] = X.values
+        return arrays
+
+    def from_arrays(self, arrays):
+        if self.sparse:
+            steps = RaggedArray(arrays['notes'], arrays['step_starts'],
+                                arrays['step_lengths'])
+        else:
+            steps = arrays['steps']
+        starts = arrays['starts']
+        X = RaggedArray(steps, starts, arrays['lengths'])
+        y = RaggedArray(steps, starts + 1, arrays['lengths'])
         return (X, y)
 
+    def pad_batch(self, batches, out=None):
+        if not self.sparse:
+            return super(Music, self).pad_batch(batches, out)
+        samples_len = batches[0].lengths
+        shape = (samples_len.max(), len(samples_len))
+        t_idx = ragged_arange(samples_len)
+        b_idx = np.repeat(np.arange(len(samples_len)), samples_len)
+        rval = []
+        for i, batch in enumerate(batches):
+            steps = batch.values
+            s_idx = np.repeat(batch.starts, samples_len) + t_idx
+            nnotes = steps.lengths[s_idx]
+            n_idx = np.repeat(steps.starts[s_idx], nnotes) + ragged_arange(nnotes)
+            z = reuse_buffer(out, ('pad', i), shape + (self.nlabel,),
+                             np.float32)
+            z[...] = 0
+            z[np.repeat(t_idx, nnotes), np.repeat(b_idx, nnotes),
+              steps.values[n_idx]] = 1
+            rval.append(z)
+        mask = reuse_buffer(out, ('mask',), shape, np.float32)
+        rval.append(self.create_mask(batches[0], mask))
+        return tuple(rval)
+
     def theano_vars(self):
         return [T.ftensor3('x'), T.ftensor3('y'), T.fmatrix('mask')]
-
-    def list2nparray(self, x, dim):
-        z = np.zeros((dim,), dtype=np.float32)
-        for i in x:
-            z[i-1] = 1
-        return z
@@ -3,10 +3,11 @@ import numpy as np
 import theano
 import theano.tensor as T
 
-from cle.cle.cost import NllMul
+from cle.cle.cost import NllMulInd
 from cle.cle.data import Iterator
+from cle.cle.graph.net import merge_projections
 from cle.cle.models import Model
-from cle.cle.layers import InitCell, OnehotLayer
+from cle.cle.layers import InitCell
 from cle.cle.layers.feedforward import FullyConnectedLayer
 from cle.cle.layers.recurrent import GFLSTM
 from cle.cle.train import Training
@@ -17,7 +18,7 @@ from cle.cle.train.ext import (
     Picklize
 )
 from cle.cle.train.opt import Adam
-from cle.cle.utils import flatten, sharedX, unpack, OrderedDict
+from cle.cle.utils import flatten, unpack, OrderedDict
 from cle.datasets.enwiki import EnWiki
 
 
@@ -30,10 +31,19 @@ debug = 0
 
 model = Model()
 trdata = EnWiki(name='train',
+                batch_size=batch_size,
                 path=data_path)
 tedata = EnWiki(name='test',
+                batch_size=batch_size,
                 path=data_path)
 
+# Batches are time-major and each row is one stream, so the state
+# carried from the last step lines up with the next batch's rows
+# only when the streams, batches and layer states agree in size
+assert trdata.slices(0, batch_size)[0].shape ==\
+    (trdata.context_len, batch_size, 1),\
+    "EnWiki batches should be (context_len, batch_size, 1)."
+
 init_W = InitCell('rand')
 init_U = InitCell('ortho')
 init_b = InitCell('zeros')
@@ -43,16 +53,13 @@ if debug:
     x.tag.test_value = np.zeros((10, batch_size, 1), dtype=np.float32)
     y.tag.test_value = np.zeros((10, batch_size, 1), dtype=np.float32)
 
-onehot = OnehotLayer(name='onehot',
-                     parent=['x'],
-                     nout=205)
-
 h1 = GFLSTM(name='h1',
             parent=['x'],
             parent_dim=[205],
             recurrent=['h2', 'h3'],
             recurrent_dim=[200, 200],
             batch_size=batch_size,
+            persistent=1,
             nout=200,
             unit='tanh',
             init_W=init_W,
@@ -65,6 +72,7 @@ h2 = GFLSTM(name='h2',
             recurrent=['h1', 'h3'],
             recurrent_dim=[200, 200],
             batch_size=batch_size,
+            persistent=1,
             nout=200,
             unit='tanh',
             init_W=init_W,
@@ -77,6 +85,7 @@ h3 = GFLSTM(name='h3',
             recurrent=['h1', 'h2'],
             recurrent_dim=[200, 200],
             batch_size=batch_size,
+            persistent=1,
             nout=200,
             unit='tanh',
             init_W=init_W,
@@ -91,46 +100,34 @@ h4 = FullyConnectedLayer(name='h4',
                          init_W=init_W,
                          init_b=init_b)
 
-nodes = [onehot, h1, h2, h3, h4]
+nodes = [h1, h2, h3, h4]
 
 for node in nodes:
     node.initialize()
 
 params = flatten([node.get_params().values() for node in nodes])
 
-step_count = sharedX(0, name='step_count')
-last_h = np.zeros((batch_size, 400), dtype=np.float32)
-h1_tm1 = sharedX(last_h, name='h1_tm1')
-h2_tm1 = sharedX(last_h, name='h2_tm1')
-h3_tm1 = sharedX(last_h, name='h3_tm1')
-update_list = [step_count, h1_tm1, h2_tm1, h3_tm1]
-
-step_count = T.switch(T.le(step_count, reset_freq),
-                      step_count + 1, 0)
-
-h1_init_state = T.switch(
-                T.or_(T.cast(T.eq(step_count, 0), 'int32'),
-                      T.cast(T.eq(T.sum(h1_tm1), 0.), 'int32')),
-                h1.get_init_state(), h1_tm1
-            )
-h2_init_state = T.switch(
-                T.or_(T.cast(T.eq(step_count, 0), 'int32'),
-                      T.cast(T.eq(T.sum(h2_tm1), 0.), 'int32')),
-                h2.get_init_state(), h2_tm1
-            )
-h3_init_state = T.switch(
-                T.or_(T.cast(T.eq(step_count, 0), 'int32'),
-                      T.cast(T.eq(T.sum(h3_tm1), 0.), 'int32')),
-                h3.get_init_state(), h3_tm1
-            )
-
-
-def inner_fn(i_t, h1_tm1, h2_tm1, h3_tm1):
-
-    x_t = onehot.fprop([i_t])
-    h1_t = h1.fprop([[x_t], [h1_tm1, h2_tm1, h3_tm1]])
-    h2_t = h2.fprop([[x_t, h1_t], [h2_tm1, h1_tm1, h3_tm1]])
-    h3_t = h3.fprop([[x_t, h2_t], [h3_tm1, h1_tm1, h2_tm1]])
+# States are carried over between batches in the layers' buffers,
+# Training resets them every reset_freq batches
+h1_init_state = h1.get_init_state()
+h2_init_state = h2.get_init_state()
+h3_init_state = h3.get_init_state()
+
+# Project the inputs of all timesteps at once, gathering the rows
+# of the three layers' W for the characters rather than building
+# their one-hot vectors, only the recurrent terms are left to the
+# scan steps
+x_h1, x_h2, x_h3 = merge_projections(x, 'x', [h1, h2, h3], use_index=1)
+h1_in = h1.params['b_h1'] + x_h1
+h2_in = h2.params['b_h2'] + x_h2
+h3_in = h3.params['b_h3'] + x_h3
+
+
+def inner_fn(h1_in_t, h2_in_t, h3_in_t, h1_tm1, h2_tm1, h3_tm1):
+
+    h1_t = h1.fprop([[None], [h1_tm1, h2_tm1, h3_tm1]], h1_in_t)
+    h2_t = h2.fprop([[None, h1_t], [h2_tm1, h1_tm1, h3_tm1]], h2_in_t)
+    h3_t = h3.fprop([[None, h2_t], [h3_tm1, h1_tm1, h2_tm1]], h3_in_t)
     y_hat = h4.fprop([h1_t, h2_t, h3_t])
 
     return h1_t, h2_t, h3_t, y_hat
@@ -138,24 +135,24 @@ def inner_fn(i_t, h1_tm1, h2_tm1, h3_tm1):
 ((h1_t, h2_t, h3_t, y_hat),
  updates) =\
     theano.scan(fn=inner_fn,
-                sequences=[x],
+                sequences=[h1_in, h2_in, h3_in],
                 outputs_info=[h1_init_state,
                               h2_init_state,
                               h3_init_state,
                               None])
 
-reshaped_y = y.reshape((y.shape[0]*y.shape[1], -1))
-reshaped_y = onehot.fprop([reshaped_y])
 reshaped_y_hat = y_hat.reshape((y_hat.shape[0]*y_hat.shape[1], -1))
 
-cost = NllMul(reshaped_y, reshaped_y_hat)
+cost = NllMulInd(y, reshaped_y_hat)
 cost = cost.mean()
 cost.name = 'cost'
 
 model.inputs = [x, y]
 model._params = params
 model.nodes = nodes
-model.set_updates(update_list)
+model.updates[h1.state] = h1_t[-1]
+model.updates[h2.state] = h2_t[-1]
+model.updates[h3.state] = h3_t[-1]
 
 optimizer = Adam(
     lr=0.001
@@ -177,6 +174,7 @@ mainloop = Training(
     optimizer=optimizer,
     cost=cost,
     outputs=[cost],
+    reset_freq=reset_freq,
     extension=extension
 )
 mainloop.run()
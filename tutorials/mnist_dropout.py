@@ -104,7 +104,6 @@ mn_cost = mlp.nodes['cost'].out
 mn_cost.name = 'mn_cost'
 mn_err = error(predict(mlp.nodes['h3'].out), predict(mlp.nodes['onehot'].out))
 mn_err.name = 'mn_err'
-monitor_fn = theano.function(inputs, [mn_cost, mn_err])
 
 # Define your optimizer: Momentum (Nesterov), RMSProp, Adam
 optimizer = RMSProp(
@@ -117,8 +116,7 @@ extension = [
     Monitoring(freq=100,
                ddout=[mn_cost, mn_err],
                data=[Iterator(trdata, batch_size),
-                     Iterator(valdata, batch_size)],
-               monitor_fn=monitor_fn),
+                     Iterator(valdata, batch_size)]),
     Picklize(freq=1000000,
              path=save_path),
     WeightNorm(param_name='W')    
@@ -89,7 +89,8 @@ h4 = FullyConnectedLayer(name='h4',
 
 nodes = [h1, h2, h3, h4]
 rnn = Net(inputs=inputs, inputs_dim=inputs_dim, nodes=nodes)
-y_hat = rnn.build_recurrent_graph(output_args=[h4])[0]
+y_hat = rnn.build_recurrent_graph(output_args=[h4], precompute=1,
+                                  merge=1)[0]
 masked_y = y[mask.nonzero()]
 masked_y_hat = y_hat[mask.nonzero()]
 cost = NllBin(masked_y, masked_y_hat).sum()
@@ -115,7 +116,7 @@ extension = [
 
 mainloop = Training(
     name='toy_music',
-    data=Iterator(trdata, batch_size),
+    data=Iterator(trdata, batch_size, reuse=1),
     model=model,
     optimizer=optimizer,
     cost=cost,